@@ -1,11 +1,14 @@
 import os
 import arcpy
 import geopandas as gpd
-import yaml
 
 
+from src.bike_coverage import bike_coverage
 from src.preprocess import preprocess
-from src.process_poi import filter_POIs
+from src.server import server_available, request_preprocess, input_fingerprints
+from src.process_poi import filter_POIs, poi_road_distance_sweep
+from src.config import _parse_distances
+from src.tiles import export_display_layers
 
 
 class Toolbox(object):
@@ -172,10 +175,49 @@ class RuralActiveTransportAnalysis(object):
             direction="Input"
         )
 
+        # Input 13: buffer distances for the POI accessibility sensitivity sweep
+        road_buffer_sweep = arcpy.Parameter(
+            displayName="Buffer Distances for POI Sensitivity Sweep (feet, comma separated)",
+            name="road_buffer_sweep",
+            datatype="GPString",
+            parameterType="Optional",
+            direction="Input"
+        )
+        road_buffer_sweep.value = "150, 300, 500, 1000, 2640"
+
+        # Input 14: existing bike facilities (e.g. WSDOT bike paths along state routes)
+        bike_paths_fc = arcpy.Parameter(
+            displayName="Bike Facilities Layer",
+            name="bike_paths_fc",
+            datatype="DEFeatureClass",
+            parameterType="Optional",
+            direction="Input"
+        )
+
+        # Input 15: area water (e.g. a folder with the TIGER/Line AREAWATER shapefiles of the state)
+        water_path = arcpy.Parameter(
+            displayName="Area Water Layer or Folder (erased from census block groups)",
+            name="water_path",
+            datatype=["DEFeatureClass", "DEFolder"],
+            parameterType="Optional",
+            direction="Input"
+        )
+
+        # Input 16: distance bands to population centers, used to compare "right outside" definitions
+        distance_bands_mi = arcpy.Parameter(
+            displayName="Distance Bands to Population Centers (miles, comma separated)",
+            name="distance_bands_mi",
+            datatype="GPString",
+            parameterType="Optional",
+            direction="Input"
+        )
+        distance_bands_mi.value = "1, 3, 5"
+
         return [
             state_name, county_field, county_names, population_fc,
             sld_cbg_path, state_roads_fc, county_roads_fc, parcel_fc,
-            parcel_field, poi_geojson, road_buffer_dist, nces_path, output_gdb, save_path
+            parcel_field, poi_geojson, road_buffer_dist, nces_path, output_gdb, save_path,
+            road_buffer_sweep, bike_paths_fc, water_path, distance_bands_mi
         ]
 
     def execute(self, parameters, messages):
@@ -190,6 +232,7 @@ class RuralActiveTransportAnalysis(object):
 
 
             ###### option2: input just a config file address ######
+            # from src.config import _extract_params_from_config
             # parameters = _extract_params_from_config(parameters[0].valueAsText)
             ## uncomment when passing a config file from ArcGIS
             self._extract_params_from_list(parameters)
@@ -212,8 +255,15 @@ class RuralActiveTransportAnalysis(object):
 
             # for developement, you can run this code once and then comment it for future runs when
             # outputs are still saved in save_path
-            preprocess(self.state_name, self.county_names, self.sld_cbg_path,
-                       self.population_fc, self.nces_path, self.parcel_fc, save_path=self.save_path)
+            if server_available(self.state_name, input_fingerprints(self.sld_cbg_path, self.population_fc,
+                                                                    self.nces_path, self.parcel_fc, self.water_path)):
+                # base layers are already loaded by `python -m src.cli serve`, only the county part runs
+                arcpy.AddMessage("   using the running analysis server")
+                request_preprocess(self.county_names, self.save_path, distance_bands_mi=self.distance_bands_mi)
+            else:
+                preprocess(self.state_name, self.county_names, self.sld_cbg_path,
+                           self.population_fc, self.nces_path, self.parcel_fc, save_path=self.save_path,
+                           water_path=self.water_path, distance_bands_mi=self.distance_bands_mi)
 
             # ==============================================================
             # STEP 1: SELECT COUNTIES
@@ -238,6 +288,10 @@ class RuralActiveTransportAnalysis(object):
                                                                     'POPULATION_CENTERS_STUDY_AREA.gpkg')
             pop_count = int(arcpy.GetCount_management(self.pop_centers_selected)[0])
             arcpy.AddMessage(f"   Found {pop_count} population centers")
+            # the same centers dissolved into one polygon during preprocessing. Erasing with a single polygon is
+            # faster than with the individual (overlapping) centers and gives the same result.
+            self.pop_centers_dissolved = self.add_fc_from_geopackage('Step2_Population_Centers_Dissolved',
+                                                                     'POPULATION_CENTERS_DISSOLVED.gpkg')
 
             # ==============================================================
             # STEP 3: HIGHLIGHT CENSUS BLOCK GROUPS
@@ -291,6 +345,14 @@ class RuralActiveTransportAnalysis(object):
 
             arcpy.AddMessage(f"   Rural roads network: {total_miles:.2f} miles")
 
+            if self.bike_paths_fc:
+                # which rural road miles already have a bike facility (per road and per CBG)
+                roads_gdf = gpd.read_file(self.output_gdb, layer=os.path.basename(self.roads_final))
+                roads_coverage, _, _ = bike_coverage(roads_gdf, gpd.read_file(self.bike_paths_fc),
+                                                     save_path=self.save_path)
+                arcpy.AddMessage(f"   Rural roads with bike facilities: "
+                                 f"{roads_coverage['covered_mi'].sum():.2f} miles")
+
             # ==============================================================
             # STEP 5: PARCELS DATA IN CBGs OUTSIDE POPULATION CENTERS
             # ==============================================================
@@ -361,11 +423,33 @@ class RuralActiveTransportAnalysis(object):
                     (self.pois_accessible_filtered, "Accessible POIs")
                 ]
 
+                # simplified copies of the layers for the smaller scales, the full resolution layer is only drawn
+                # when zoomed in (see src/tiles.py)
+                display_layers = {}
+                try:
+                    display_layers = export_display_layers(
+                        {os.path.basename(layer_path): gpd.read_file(os.path.dirname(layer_path),
+                                                                     layer=os.path.basename(layer_path))
+                         for layer_path, _ in layer_info if arcpy.Exists(layer_path)},
+                        self.save_path, coverage_layers=[os.path.basename(self.cbg_clipped)])
+                except Exception as e:
+                    arcpy.AddWarning(f"Could not build simplified display layers: {str(e)}")
+                display_gpkg = os.path.join(self.save_path, 'display_layers.gpkg')
+
                 for layer_path, layer_name in layer_info:
                     if arcpy.Exists(layer_path):
+                        full_res_min_scale = 0
+                        for gpkg_layer, min_scale, max_scale in display_layers.get(os.path.basename(layer_path), []):
+                            if max_scale == 0:  # point layers are not simplified
+                                continue
+                            layer = map_obj.addDataFromPath(os.path.join(display_gpkg, f'main.{gpkg_layer}'))
+                            layer.name = layer_name
+                            layer.minThreshold, layer.maxThreshold = min_scale, max_scale
+                            full_res_min_scale = max_scale
                         layer = map_obj.addDataFromPath(layer_path)
                         if hasattr(layer, 'name'):
                             layer.name = layer_name
+                            layer.minThreshold = full_res_min_scale
 
                 # Zoom to extent of selected counties
                 map_view = aprx.activeView
@@ -467,7 +551,7 @@ class RuralActiveTransportAnalysis(object):
         # Remove roads inside population centers
         roads_outside_pop = os.path.join(self.output_gdb, f"Step4_{road_type}_Roads_Outside_PopCenters")
         self._delete_if_exists(roads_outside_pop)
-        arcpy.Erase_analysis(roads_clipped, self.pop_centers_selected, roads_outside_pop)
+        arcpy.Erase_analysis(roads_clipped, self.pop_centers_dissolved, roads_outside_pop)
         # C:\Users\Soheil99\OneDrive - UW\0
         # Research\UW
         # Tacoma\my
@@ -490,7 +574,12 @@ class RuralActiveTransportAnalysis(object):
         # todo: people may want to travel into pop center's I don't think this step is needed
         pois_outside_pop = os.path.join(self.output_gdb, "Temp_POIs_Outside_PopCenters")
         self._delete_if_exists(pois_outside_pop)
-        arcpy.Erase_analysis(poi_fc, self.pop_centers_selected, pois_outside_pop)
+        arcpy.Erase_analysis(poi_fc, self.pop_centers_dissolved, pois_outside_pop)
+        if self.road_buffer_sweep:
+            # accessibility for all the sweep distances at once, from the distance of each POI to its nearest road
+            poi_road_distance_sweep(gpd.read_file(self.output_gdb, layer=os.path.basename(pois_outside_pop)),
+                                    gpd.read_file(self.output_gdb, layer=os.path.basename(self.roads_final)),
+                                    distances_ft=self.road_buffer_sweep, save_path=self.save_path)
         # Create buffer around rural roads
         self.roads_buffer = os.path.join(self.output_gdb, "Step6_Roads_Buffer_Zone")
         self._delete_if_exists(self.roads_buffer)
@@ -542,6 +631,10 @@ class RuralActiveTransportAnalysis(object):
         self.nces_path = parameters[11]
         self.output_gdb = parameters[12]
         self.save_path = parameters[13]
+        self.road_buffer_sweep = _parse_distances(parameters[14] if len(parameters) > 14 else None)
+        self.bike_paths_fc = parameters[15] if len(parameters) > 15 else None
+        self.water_path = parameters[16] if len(parameters) > 16 else None
+        self.distance_bands_mi = _parse_distances(parameters[17] if len(parameters) > 17 else None)
 
     def _extract_params_from_arcGIS(self, parameters):
         """
@@ -565,10 +658,8 @@ class RuralActiveTransportAnalysis(object):
         self.nces_path = parameters[11].valueAsText
         self.output_gdb = parameters[12].valueAsText or arcpy.env.scratchGDB
         self.save_path = parameters[13].valueAsText
+        self.road_buffer_sweep = _parse_distances(parameters[14].valueAsText)
+        self.bike_paths_fc = parameters[15].valueAsText
+        self.water_path = parameters[16].valueAsText
+        self.distance_bands_mi = _parse_distances(parameters[17].valueAsText)
 
-
-
-def _extract_params_from_config(config_file):
-    with open(config_file, "r") as f:
-        config = yaml.safe_load(f)
-    return list(config.values())
\ No newline at end of file
@@ -0,0 +1,98 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from .units import FEET_PER_METER, METERS_PER_MILE
+from .utils import _save_geopackage
+
+
+def segment_lines(geoms, max_segment_length):
+    """
+    cuts lines into straight segments no longer than max_segment_length, with array functions only (no loop over
+    features).
+    :param geoms: array of (Multi)LineStrings
+    :return: (array of 2-point LineStrings, array with the position of the source line of each segment). Repeated
+        vertices don't make a segment, so every segment has a length.
+    """
+    geoms = shapely.segmentize(np.asarray(geoms, dtype=object), max_segment_length)
+    parts, part_source = shapely.get_parts(geoms, return_index=True)
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    # a segment for every pair of consecutive, distinct vertices of the same part
+    keep = (coord_part[1:] == coord_part[:-1]) & (coords[1:] != coords[:-1]).any(axis=1)
+    segments = shapely.linestrings(np.stack([coords[:-1][keep], coords[1:][keep]], axis=1))
+    return segments, part_source[coord_part[:-1][keep]]
+
+
+def match_bike_facilities(roads_gdf, bike_gdf, tolerance_ft=50, max_segment_ft=330, min_overlap=0.5, crs=32610):
+    """
+    flags the parts of the rural roads that already have a bike facility.
+
+    Roads are cut into short segments. A segment is covered by a bike path when
+        - at least `min_overlap` of its length is within `tolerance_ft` of the bike path (buffer overlap), and
+        - the Hausdorff distance between the segment and the bike path around it is below 2 x tolerance_ft, which
+          rejects bike paths that only cross the road.
+    Candidate (segment, bike path) pairs come from one bulk STRtree query, and both tests run on arrays of pairs.
+
+    :return: GeoDataFrame of segments with 'road_idx' (row position in roads_gdf), 'length_m' and 'covered'
+    """
+    print(f'\n---- Matching {len(bike_gdf)} bike facilities to {len(roads_gdf)} road features')
+    tolerance = tolerance_ft / FEET_PER_METER
+    roads_gdf = roads_gdf.to_crs(crs)
+    bike_gdf = bike_gdf[bike_gdf.geometry.notna() & ~bike_gdf.geometry.is_empty].to_crs(crs)
+
+    segments, road_idx = segment_lines(roads_gdf.geometry.values, max_segment_ft / FEET_PER_METER)
+    length = shapely.length(segments)
+    bike_lines = np.asarray(bike_gdf.geometry.values, dtype=object)
+    bike_buffers = shapely.buffer(bike_lines, tolerance, cap_style='flat')
+
+    seg_i, bike_j = shapely.STRtree(bike_buffers).query(segments, predicate='intersects')
+    overlap = shapely.length(shapely.intersection(segments[seg_i], bike_buffers[bike_j])) / length[seg_i]
+    candidates = overlap >= min_overlap
+    seg_i, bike_j = seg_i[candidates], bike_j[candidates]
+    # the bike path around the segment, compared with the segment itself
+    xmin, ymin, xmax, ymax = shapely.bounds(segments[seg_i]).T
+    nearby_bike = shapely.intersection(bike_lines[bike_j], shapely.box(xmin - tolerance, ymin - tolerance,
+                                                                       xmax + tolerance, ymax + tolerance))
+    parallel = shapely.hausdorff_distance(segments[seg_i], nearby_bike) <= 2 * tolerance
+
+    covered = np.zeros(len(segments), dtype=bool)
+    covered[seg_i[parallel]] = True
+    return gpd.GeoDataFrame({'road_idx': road_idx, 'length_m': length, 'covered': covered},
+                            geometry=segments, crs=crs)
+
+
+def bike_coverage(roads_gdf, bike_gdf, save_path=None, **match_kwargs):
+    """
+    covered and uncovered miles of rural roads, per road feature and per CBG (if roads_gdf has GEOID10, which is
+    the case for the Step 4 output).
+    :return: (roads with coverage columns, CBG table or None, matched segments)
+    """
+    segments = match_bike_facilities(roads_gdf, bike_gdf, **match_kwargs)
+    miles = segments['length_m'] / METERS_PER_MILE
+    per_road = (pd.DataFrame({'road_idx': segments['road_idx'],
+                              'covered_mi': miles.where(segments['covered'], 0),
+                              'uncovered_mi': miles.where(~segments['covered'], 0)})
+                .groupby('road_idx').sum()
+                .reindex(np.arange(len(roads_gdf)), fill_value=0))
+    roads = roads_gdf.copy()
+    roads['covered_mi'] = per_road['covered_mi'].values
+    roads['uncovered_mi'] = per_road['uncovered_mi'].values
+    total = roads['covered_mi'] + roads['uncovered_mi']
+    roads['pct_covered'] = (100 * roads['covered_mi'] / total.where(total > 0)).round(1)
+
+    per_cbg = None
+    if 'GEOID10' in roads.columns:
+        per_cbg = roads.groupby('GEOID10')[['covered_mi', 'uncovered_mi']].sum()
+        per_cbg['pct_covered'] = (100 * per_cbg['covered_mi'] /
+                                  (per_cbg['covered_mi'] + per_cbg['uncovered_mi']).replace(0, np.nan)).round(1)
+    print(f'---- \t {roads["covered_mi"].sum():.2f} miles covered by bike facilities, '
+          f'{roads["uncovered_mi"].sum():.2f} miles without')
+
+    if save_path:
+        _save_geopackage(roads, save_path, 'rural_roads_bike_coverage.gpkg', driver='GPKG')
+        if per_cbg is not None:
+            per_cbg.to_excel(os.path.join(save_path, 'CBG_bike_coverage.xlsx'))
+    return roads, per_cbg, segments
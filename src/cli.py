@@ -0,0 +1,149 @@
+"""
+Command line entry point that runs the geopandas parts of the tool without ArcGIS.
+
+    python -m src.cli preprocess assets/example.yml
+    python -m src.cli poi --sr <SR buffered POIs> --cr <CR buffered POIs> --save-path <out dir>
+    python -m src.cli partition Parcels_2024.shp stores/parcels
+    python -m src.cli serve assets/example.yml  (then: preprocess --server ...)
+    python -m src.cli diff out_before out_after --fail-on-diff
+    python -m src.cli tiles <out dir> --max-zoom 14
+
+Only the modules a command needs are imported, so `python -m src.cli --help` starts instantly and nothing here
+imports arcpy.
+"""
+import argparse
+import sys
+import time
+
+from .config import config_to_kwargs
+
+
+def _run_preprocess(args):
+    params = config_to_kwargs(args.config)
+    if args.server:
+        from .server import input_fingerprints, request_preprocess, server_available
+        inputs = input_fingerprints(params['sld_cbg_path'], params['population_fc'], params['nces_path'],
+                                    params['parcel_fc'], params['water_path'])
+        if server_available(params['state_name'], inputs):
+            request_preprocess(params['county_names'], args.save_path or params['save_path'],
+                               incremental=args.incremental, distance_bands_mi=params['distance_bands_mi'])
+            return
+        print('---- no analysis server with the same inputs, preprocessing here')
+    from . import preprocess as preprocess_module
+    preprocess_module.overlay_memory_limit_mb = args.memory_limit_mb
+    preprocess_module.preprocess(params['state_name'], params['county_names'], params['sld_cbg_path'],
+                                 params['population_fc'], params['nces_path'], params['parcel_fc'],
+                                 save_path=args.save_path or params['save_path'], incremental=args.incremental,
+                                 water_path=params['water_path'], distance_bands_mi=params['distance_bands_mi'])
+
+
+def _run_serve(args):
+    from .server import serve, default_address
+    params = config_to_kwargs(args.config)
+    serve(params['state_name'], params['sld_cbg_path'], params['population_fc'], params['nces_path'],
+          params['parcel_fc'], address=(default_address[0], args.port), water_path=params['water_path'])
+
+
+def _run_poi(args):
+    from .process_poi import filter_SR_and_CR_POIs
+    filter_SR_and_CR_POIs(args.sr, args.cr, save_path=args.save_path)
+
+
+def _run_sweep(args):
+    import geopandas as gpd
+    from .process_poi import poi_road_distance_sweep
+    poi_road_distance_sweep(gpd.read_file(args.pois), gpd.read_file(args.roads, layer=args.roads_layer),
+                            distances_ft=args.distances, save_path=args.save_path)
+
+
+def _run_partition(args):
+    from .spatial_store import partition_layer
+    partition_layer(args.src, args.store_dir, layer=args.layer, crs=args.crs,
+                    rows_per_partition=args.rows_per_partition)
+
+
+def _run_tiles(args):
+    from .tiles import export_result_tiles
+    export_result_tiles(args.save_dir, min_zoom=args.min_zoom, max_zoom=args.max_zoom, max_workers=args.workers)
+
+
+def _run_diff(args):
+    from .diff_outputs import diff_output_dirs
+    summary = diff_output_dirs(args.old_dir, args.new_dir, grid_size=args.grid_size, save_path=args.save_path)
+    if args.fail_on_diff and (summary['status'] != 'same').any():
+        return 1
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog='python -m src.cli',
+                                     description='Rural active transportation gap analysis (no ArcGIS needed)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('preprocess', help='study area, CBGs, population centers and parcels')
+    p.add_argument('config', help='yaml config file, see assets/example.yml')
+    p.add_argument('--save-path', help='overrides "Output save directory" of the config')
+    p.add_argument('--incremental', action='store_true',
+                   help='only reprocess parcels that changed since the previous run in the save directory')
+    p.add_argument('--server', action='store_true',
+                   help='run on an analysis server started with "serve" (runs here if no server with the same '
+                        'inputs is listening)')
+    p.add_argument('--memory-limit-mb', type=float, default=None,
+                   help='process the big overlays in spatial chunks that fit in this much memory')
+    p.set_defaults(func=_run_preprocess)
+
+    p = subparsers.add_parser('serve', help='keep the base layers of the config state in memory and answer '
+                                            'preprocess requests from the toolbox or "preprocess --server"')
+    p.add_argument('config', help='yaml config file, see assets/example.yml')
+    p.add_argument('--port', type=int, default=6543)
+    p.set_defaults(func=_run_serve)
+
+    p = subparsers.add_parser('poi', help='filter POIs within the SR and CR road buffers')
+    p.add_argument('--sr', required=True, help='POIs within the state road buffer')
+    p.add_argument('--cr', required=True, help='POIs within the county road buffer')
+    p.add_argument('--save-path', required=True)
+    p.set_defaults(func=_run_poi)
+
+    p = subparsers.add_parser('sweep', help='POI accessibility for several road buffer distances in one pass')
+    p.add_argument('--pois', required=True, help='POIs outside population centers (e.g. the geojson)')
+    p.add_argument('--roads', required=True, help='rural roads, e.g. out.gdb with --roads-layer')
+    p.add_argument('--roads-layer', default=None, help='e.g. Step4_Roads_Final_In_CBG_Outside_PopCenters')
+    p.add_argument('--distances', type=float, nargs='+', default=None, help='buffer distances in feet')
+    p.add_argument('--save-path')
+    p.set_defaults(func=_run_sweep)
+
+    p = subparsers.add_parser('diff', help='compare the outputs of two runs')
+    p.add_argument('old_dir')
+    p.add_argument('new_dir')
+    p.add_argument('--grid-size', type=float, default=0.01, help='geometry tolerance in CRS units')
+    p.add_argument('--save-path', help='xlsx file for the summary')
+    p.add_argument('--fail-on-diff', action='store_true', help='exit with status 1 if anything changed')
+    p.set_defaults(func=_run_diff)
+
+    p = subparsers.add_parser('partition', help='convert a large layer into a Hilbert-partitioned store')
+    p.add_argument('src', help='input layer (shp, gpkg, gdb, geojson, ...)')
+    p.add_argument('store_dir', help='output folder; use it in place of the input path in the config')
+    p.add_argument('--layer', help='layer name inside src (e.g. EPA_SLD_Database_V3)')
+    p.add_argument('--crs', help='reproject before partitioning, e.g. EPSG:32610')
+    p.add_argument('--rows-per-partition', type=int, default=50000)
+    p.set_defaults(func=_run_partition)
+
+    p = subparsers.add_parser('tiles', help='simplified display layers and an MBTiles vector tile archive of the '
+                                            'outputs in a save directory')
+    p.add_argument('save_dir', help='"Output save directory" of a finished run')
+    p.add_argument('--min-zoom', type=int, default=6)
+    p.add_argument('--max-zoom', type=int, default=14)
+    p.add_argument('--workers', type=int, default=None, help='tile encoding processes (default: number of CPUs)')
+    p.set_defaults(func=_run_tiles)
+    return parser
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    start = time.perf_counter()
+    status = args.func(args)
+    print(f'\n---- {args.command} finished in {time.perf_counter() - start:.1f} s')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
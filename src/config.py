@@ -0,0 +1,47 @@
+import yaml
+
+
+def _extract_params_from_config(config_file):
+    """reads the yaml config (see assets/example.yml) and returns its values in the toolbox parameter order"""
+    with open(config_file, "r") as f:
+        config = yaml.safe_load(f)
+    return list(config.values())
+
+
+def config_to_kwargs(config_file):
+    """
+    maps the values of the yaml config to names. The config follows the toolbox parameter order (see
+    RuralActiveTransportAnalysis._extract_params_from_list), its keys are only display names.
+    """
+    parameters = _extract_params_from_config(config_file)
+    county_names = parameters[2]
+    if isinstance(county_names, str):
+        county_names = [c.strip() for c in county_names.split(",")]
+    return {
+        'state_name': parameters[0],
+        'county_names': county_names,
+        'population_fc': parameters[3],
+        'sld_cbg_path': parameters[4],
+        'state_roads_fc': parameters[5],
+        'county_roads_fc': parameters[6],
+        'parcel_fc': parameters[7],
+        'parcel_field': parameters[8],
+        'poi_geojson': parameters[9],
+        'road_buffer_dist': float(parameters[10] or 300),
+        'nces_path': parameters[11],
+        'output_gdb': parameters[12],
+        'save_path': parameters[13],
+        'road_buffer_sweep': _parse_distances(parameters[14]) if len(parameters) > 14 else None,
+        'bike_paths_fc': parameters[15] if len(parameters) > 15 else None,
+        'water_path': parameters[16] if len(parameters) > 16 else None,
+        'distance_bands_mi': _parse_distances(parameters[17]) if len(parameters) > 17 else None,
+    }
+
+
+def _parse_distances(distances):
+    """'150, 300, 500' or [150, 300, 500] -> [150.0, 300.0, 500.0]. Empty input gives [] (e.g. no sweep)."""
+    if not distances:
+        return []
+    if isinstance(distances, str):
+        distances = distances.split(",")
+    return [float(d) for d in distances]
@@ -0,0 +1,146 @@
+"""
+Compares two output folders of the pipeline (e.g. before and after a refactor or a data refresh) instead of checking
+row counts by eye.
+
+    python -m src.cli diff out_before out_after --fail-on-diff
+
+Every spatial file (gpkg, GeoParquet, shp) found in both folders, outside the cache folder, is matched by relative
+path. Features are keyed on GEOID10 / parcel id / Overture id when one of them is a unique column, and geometries are
+compared with a hash of their normalized WKB snapped to a grid, so vertex order and sub-tolerance noise don't count as
+changes. Layers without such a key are compared as multisets of rows (attributes + geometry hash).
+"""
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from .fields import parcel_id_fields
+from .utils import _hash_geometries
+
+
+key_columns = ['GEOID10', *parcel_id_fields, 'id']
+spatial_extensions = ('.gpkg', '.parquet', '.shp')
+# folders of an output folder that hold caches (projected input copies, population center index), not outputs
+skipped_dirs = ('cache',)
+
+
+def _read(path):
+    if path.endswith('.parquet'):
+        return gpd.read_parquet(path)
+    return gpd.read_file(path)
+
+
+def _find_key(old_gdf, new_gdf):
+    for col in key_columns:
+        if col in old_gdf.columns and col in new_gdf.columns and old_gdf[col].is_unique and new_gdf[col].is_unique:
+            return col
+    return None
+
+
+def _changed_mask(old, new):
+    """True where two aligned columns differ (NaN == NaN, floats compared with np.isclose)"""
+    both_na = old.isna() & new.isna()
+    if pd.api.types.is_numeric_dtype(old) and pd.api.types.is_numeric_dtype(new):
+        same = np.isclose(old.astype(float), new.astype(float), rtol=1e-9, atol=1e-9)
+    else:
+        same = (old.astype(str) == new.astype(str)).values
+    return ~(same | both_na.values)
+
+
+def _row_hashes(gdf, columns, geometry_hashes):
+    """
+    hash of the attributes in `columns` and the geometry hash of every row. Numbers are compared as floats rounded
+    like _changed_mask does, and missing values are all the same, so only real changes give a different hash.
+    """
+    frame = pd.DataFrame(index=pd.RangeIndex(len(gdf)))
+    for col in columns:
+        values = gdf[col].reset_index(drop=True)
+        if pd.api.types.is_numeric_dtype(values):
+            frame[col] = values.astype(float).round(9)
+        else:
+            frame[col] = values.astype(str).where(values.notna(), None)
+    frame['__geometry'] = geometry_hashes
+    return pd.util.hash_pandas_object(frame, index=False)
+
+
+def diff_layers(old_gdf, new_gdf, key=None, grid_size=0.01):
+    """
+    :param key: column identifying features in both layers (default: first unique column of key_columns). Without a
+        key, rows are matched by a hash of their shared attributes and geometry, and only added/removed counts are
+        reported (a changed row is one removed and one added row).
+    :param grid_size: geometry tolerance in CRS units
+    :return: dict with 'key', 'added', 'removed', 'geometry_changed' (arrays of keys) and 'attributes' (number of
+        changed values per column)
+    """
+    if old_gdf.crs is not None and new_gdf.crs is not None and old_gdf.crs != new_gdf.crs:
+        new_gdf = new_gdf.to_crs(old_gdf.crs)
+    key = key or _find_key(old_gdf, new_gdf)
+    old_hash = pd.Series(_hash_geometries(old_gdf.geometry.values, grid_size))
+    new_hash = pd.Series(_hash_geometries(new_gdf.geometry.values, grid_size))
+
+    if key is None:
+        # multiset difference of row hashes
+        columns = [c for c in old_gdf.columns.intersection(new_gdf.columns) if c != old_gdf.geometry.name]
+        old_hash = _row_hashes(old_gdf, columns, old_hash.values)
+        new_hash = _row_hashes(new_gdf, columns, new_hash.values)
+        counts = pd.concat([old_hash.value_counts().rename('old'), new_hash.value_counts().rename('new')],
+                           axis=1).fillna(0)
+        return {'key': None,
+                'added': np.repeat(counts.index.values, (counts['new'] - counts['old']).clip(lower=0).astype(int)),
+                'removed': np.repeat(counts.index.values, (counts['old'] - counts['new']).clip(lower=0).astype(int)),
+                'geometry_changed': np.array([]), 'attributes': pd.Series(dtype=int)}
+
+    old_keys = pd.Index(old_gdf[key].values)
+    new_keys = pd.Index(new_gdf[key].values)
+    common = old_keys.intersection(new_keys)
+    old_pos = old_keys.get_indexer(common)
+    new_pos = new_keys.get_indexer(common)
+
+    geom_changed = old_hash.values[old_pos] != new_hash.values[new_pos]
+    attribute_columns = [c for c in old_gdf.columns.intersection(new_gdf.columns)
+                         if c not in (key, old_gdf.geometry.name)]
+    attributes = pd.Series({col: int(_changed_mask(old_gdf[col].iloc[old_pos].reset_index(drop=True),
+                                                   new_gdf[col].iloc[new_pos].reset_index(drop=True)).sum())
+                            for col in attribute_columns}, dtype=int)
+    return {'key': key,
+            'added': new_keys.difference(old_keys).values,
+            'removed': old_keys.difference(new_keys).values,
+            'geometry_changed': common.values[geom_changed],
+            'attributes': attributes[attributes > 0]}
+
+
+def _spatial_files(folder):
+    files = set()
+    for root, dirs, names in os.walk(folder):
+        if os.path.samefile(root, folder):
+            dirs[:] = [d for d in dirs if d not in skipped_dirs]
+        for name in names:
+            if name.endswith(spatial_extensions):
+                files.add(os.path.relpath(os.path.join(root, name), folder))
+    return files
+
+
+def diff_output_dirs(old_dir, new_dir, grid_size=0.01, save_path=None):
+    """
+    diffs every spatial output found in both folders
+    :return: data frame with one row per file
+    """
+    old_files, new_files = _spatial_files(old_dir), _spatial_files(new_dir)
+    rows = []
+    for name in sorted(old_files | new_files):
+        if name not in new_files or name not in old_files:
+            rows.append({'file': name, 'status': 'only in old' if name in old_files else 'only in new'})
+            continue
+        old_gdf, new_gdf = _read(os.path.join(old_dir, name)), _read(os.path.join(new_dir, name))
+        d = diff_layers(old_gdf, new_gdf, grid_size=grid_size)
+        changed = len(d['added']) + len(d['removed']) + len(d['geometry_changed']) + len(d['attributes'])
+        rows.append({'file': name, 'status': 'changed' if changed else 'same', 'key': d['key'],
+                     'old_rows': len(old_gdf), 'new_rows': len(new_gdf), 'added': len(d['added']),
+                     'removed': len(d['removed']), 'geometry_changed': len(d['geometry_changed']),
+                     'attributes_changed': ', '.join(f'{c} ({n})' for c, n in d['attributes'].items())})
+    summary = pd.DataFrame(rows)
+    print(summary.to_string(index=False))
+    if save_path:
+        summary.to_excel(save_path, index=False)
+    return summary
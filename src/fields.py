@@ -0,0 +1,9 @@
+"""
+Column names of the input layers that are used by more than one module. Kept in their own module, so the output
+diff can use them without importing the preprocessing.
+"""
+# parcel id of the WA statewide parcel layer, under its full name and the 10 character name it gets in a shapefile
+# (Parcels_2024.shp)
+parcel_id_fields = ['PARCEL_ID_NR', 'PARCEL_ID_']
+# parcel ids are only unique within a county, so a parcel is identified by its county and its id
+parcel_county_field = 'FIPS_NR'
@@ -0,0 +1,107 @@
+"""
+Reads the input layers into the working CRS once.
+
+Every layer is read around the study area and only the features that are left are reprojected:
+    - the study area (dissolved, buffered by mask_buffer_m so reprojecting its edges can't drop features along the
+      boundary) is pushed down into the read. GDAL filters plain files (gpd.read_file(..., mask=...)) and partitioned
+      stores only open the partitions it overlaps (see spatial_store)
+    - with a cache_dir, the projected layer is saved as GeoParquet under a key made of the source path and
+      fingerprint, the layer name, the mask and the CRS. The next run with the same inputs reads that copy and doesn't
+      touch the source or pyproj again. Copies of an older version of the same source are deleted when a new one is
+      written.
+
+    parcels = read_projected('Parcels_2024.gdb', 32610, mask=studyarea, cache_dir='out/cache')
+
+Stages that work in the working CRS call check_crs on their inputs, so a layer that was not read through here is
+reported where it comes in, instead of silently giving wrong areas and distances.
+"""
+import glob
+import hashlib
+import os
+import re
+
+import geopandas as gpd
+import shapely
+from pyproj import CRS as pyCRS
+
+from .spatial_store import is_partitioned_store, read_layer
+from .utils import _file_fingerprint, _hash_geometries
+
+
+projected_dirname = 'projected'  # subfolder of the cache folder with the projected copies
+mask_buffer_m = 1000
+mask_simplify_m = 100  # smaller than the buffer, so the simplified mask still covers the whole study area
+
+
+def check_crs(gdf, crs, stage):
+    """
+    raises a ValueError if gdf is not in crs
+    :param stage: name of the step that got the data, for the error message
+    """
+    if gdf.crs is None or not gdf.crs.equals(crs):
+        raise ValueError(f'{stage} expects data in {pyCRS.from_user_input(crs).to_string()} but got {gdf.crs}. '
+                         f'Read the layer with ingest.read_projected')
+
+
+def _pushdown_mask(mask, crs):
+    """the study area as one buffered and simplified polygon in crs (a GeoSeries, so readers can reproject it)"""
+    geom = shapely.union_all(shapely.make_valid(mask.to_crs(crs).geometry.values))
+    geom = shapely.simplify(shapely.buffer(geom, mask_buffer_m), mask_simplify_m)
+    return gpd.GeoSeries([geom], crs=crs)
+
+
+def _cache_name(path, layer, mask, crs):
+    """
+    :return: (prefix shared by every copy of this source, file name of the copy). The prefix has a hash of the
+        absolute path, so sources with the same file name in different folders don't share it
+    """
+    stem = re.sub(r'\W', '', os.path.splitext(os.path.basename(os.path.normpath(path)))[0] + (layer or ''))
+    path_key = hashlib.sha1(os.path.normcase(os.path.abspath(path)).encode()).hexdigest()[:8]
+    stem = f'{stem}_{path_key}'
+    mask_key = f'{_hash_geometries(mask.values, grid_size=1)[0]:x}' if mask is not None else 'all'
+    crs = pyCRS.from_user_input(crs)
+    crs_key = crs.to_epsg() or hashlib.sha1(crs.to_wkt().encode()).hexdigest()[:8]
+    return stem, f'{stem}_{_file_fingerprint(path)}_{mask_key}_{crs_key}.parquet'
+
+
+def _remove_stale_copies(cache_path, stem):
+    """projected copies of the same source (same name and path) with a different fingerprint are from an older
+    version of the file"""
+    fingerprint = os.path.basename(cache_path).rsplit('_', 3)[1]
+    for old in glob.glob(os.path.join(os.path.dirname(cache_path), f'{glob.escape(stem)}_*.parquet')):
+        parts = os.path.basename(old).rsplit('_', 3)
+        if parts[0] == stem and parts[1] != fingerprint:
+            os.remove(old)
+
+
+def read_projected(path, crs, layer=None, mask=None, cache_dir=None):
+    """
+    reads a layer (file, folder source like a .gdb, or partitioned store) around `mask` and reprojects it to crs
+    :param mask: study area (GeoDataFrame or GeoSeries, any CRS). Features that don't come near it are not read.
+    :param cache_dir: folder for the projected copies. Without it, the source is read and reprojected every time
+    :return: geo dataframe in crs
+    """
+    if mask is not None:
+        mask = _pushdown_mask(mask, crs)
+    cache_path = None
+    if cache_dir:
+        stem, filename = _cache_name(path, layer, mask, crs)
+        cache_path = os.path.join(cache_dir, projected_dirname, filename)
+        if os.path.exists(cache_path):
+            print(f'---- \t using the projected copy {cache_path}')
+            return gpd.read_parquet(cache_path)
+
+    if mask is None or is_partitioned_store(path):
+        gdf = read_layer(path, layer=layer, mask=mask)
+    else:
+        # the feature ids are kept as the index, so the index labels (e.g. PC_NEAR_ID) don't depend on the mask
+        gdf = gpd.read_file(path, layer=layer, mask=mask, fid_as_index=True)
+    gdf = gdf.to_crs(crs)
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # written under a temporary name first, so a run that stops while writing doesn't leave a broken copy
+        gdf.to_parquet(cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+        _remove_stale_copies(cache_path, stem)
+    return gdf
@@ -0,0 +1,121 @@
+"""
+Overlay and clip that work on the left layer in spatially coherent chunks, so the working memory of the geometry
+operations is bounded by a chunk instead of the whole layer.
+
+Left features are sorted along a Hilbert curve and processed a chunk at a time against only the right features
+whose index entries overlap the chunk. With `memory_limit_mb`, chunks are made small enough that one chunk and its
+intermediate frames stay under the limit.
+
+iter_overlay / iter_clip hand the chunk results to the caller one by one, so a caller that reduces them (e.g. keeps
+the largest intersection of each CBG) never holds the whole result. chunked_overlay / chunked_clip return the
+whole result like gpd.overlay / gpd.clip, in the same order, so they need the memory of the result itself.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from .utils import _clip_to_mask, _mask_geometry
+
+
+_left_pos = '__left_pos'
+_right_pos = '__right_pos'
+# intermediate frames of gpd.overlay / clip on a chunk are a few times the size of the chunk itself
+_working_factor = 4
+
+
+def _hilbert_chunks(gdf, chunk_rows):
+    """row positions of gdf in chunks of nearby features"""
+    order = np.argsort(gdf.geometry.hilbert_distance(total_bounds=gdf.total_bounds).values, kind='stable')
+    for start in range(0, len(order), chunk_rows):
+        yield np.sort(order[start:start + chunk_rows])
+
+
+def _estimate_mb(gdf):
+    geom_bytes = shapely.get_num_coordinates(gdf.geometry.values).sum() * 16
+    attr_bytes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).memory_usage(deep=True).sum()
+    return (geom_bytes + attr_bytes) / 2 ** 20
+
+
+def _chunk_rows(gdf, chunk_rows, memory_limit_mb):
+    """chunk_rows, or fewer rows if a chunk of gdf would not fit in memory_limit_mb (estimated on a sample)"""
+    if memory_limit_mb is None or len(gdf) == 0:
+        return chunk_rows
+    sample = gdf.iloc[np.linspace(0, len(gdf) - 1, min(len(gdf), 1000)).astype(int)]
+    mb_per_row = _estimate_mb(sample) / len(sample) * _working_factor
+    return int(max(1, min(chunk_rows, memory_limit_mb // mb_per_row if mb_per_row else chunk_rows)))
+
+
+def iter_overlay(left, right, how='intersection', chunk_rows=20000, memory_limit_mb=None, **overlay_kwargs):
+    """
+    gpd.overlay(left, right, how='intersection') chunk by chunk. Yields the result of each chunk with the row
+    positions of its left and right features in __left_pos / __right_pos. Chunks come in Hilbert order.
+    """
+    if how != 'intersection':
+        raise ValueError(f'chunked overlays only support how="intersection", got {how!r}')
+    for positions in _hilbert_chunks(left, _chunk_rows(left, chunk_rows, memory_limit_mb)):
+        chunk = left.iloc[positions].assign(**{_left_pos: positions})
+        candidates = np.unique(right.sindex.query(chunk.geometry, predicate='intersects')[1])
+        result = gpd.overlay(chunk, right.iloc[candidates].assign(**{_right_pos: candidates}), how=how,
+                             **overlay_kwargs)
+        if not result.empty:
+            yield result
+
+
+def chunked_overlay(left, right, how='intersection', chunk_rows=20000, memory_limit_mb=None, **overlay_kwargs):
+    """
+    drop-in replacement for gpd.overlay(left, right, how='intersection'). With memory_limit_mb=None it just calls
+    gpd.overlay.
+    """
+    if memory_limit_mb is None:
+        return gpd.overlay(left, right, how=how, **overlay_kwargs)
+    parts = list(iter_overlay(left, right, how=how, chunk_rows=chunk_rows, memory_limit_mb=memory_limit_mb,
+                              **overlay_kwargs))
+    if not parts:
+        return gpd.overlay(left.iloc[:0], right.iloc[:0], how=how, **overlay_kwargs)
+    # gpd.overlay returns the pairs ordered by left then right position, with a fresh RangeIndex
+    result = pd.concat(parts, ignore_index=True)
+    del parts
+    order = np.lexsort((result[_right_pos].values, result[_left_pos].values))
+    return result.drop(columns=[_left_pos, _right_pos]).take(order).reset_index(drop=True)
+
+
+def _clip_chunks(gdf, mask, chunk_rows, memory_limit_mb, clip_func):
+    """clipped chunks of gdf, indexed by row position in gdf"""
+    for positions in _hilbert_chunks(gdf, _chunk_rows(gdf, chunk_rows, memory_limit_mb)):
+        yield clip_func(gdf.iloc[positions].set_axis(positions), mask)
+
+
+def _clip_setup(gdf, mask, clip_func):
+    if clip_func is None:
+        # the mask is dissolved and prepared once for all chunks
+        return _clip_to_mask, _mask_geometry(mask, gdf.crs)
+    return clip_func, mask
+
+
+def iter_clip(gdf, mask, chunk_rows=50000, memory_limit_mb=None, clip_func=None):
+    """gpd.clip(gdf, mask) chunk by chunk. Yields the clipped rows of each chunk with the index of gdf."""
+    clip_func, mask = _clip_setup(gdf, mask, clip_func)
+    for part in _clip_chunks(gdf, mask, chunk_rows, memory_limit_mb, clip_func):
+        yield part.set_axis(gdf.index[part.index.values])
+
+
+def chunked_clip(gdf, mask, chunk_rows=50000, memory_limit_mb=None, clip_func=None):
+    """
+    gpd.clip(gdf, mask) chunk by chunk. The index of gdf is kept and rows stay in the order of gdf.
+    Only the positions and clipped geometries of each chunk are kept; the attributes of the result are taken from
+    gdf once at the end.
+    :param clip_func: clip function applied to each chunk (default _clip_to_mask)
+    """
+    clip_func, mask = _clip_setup(gdf, mask, clip_func)
+    if memory_limit_mb is None:
+        return clip_func(gdf, mask)
+    positions, geoms = [np.array([], dtype=int)], [np.array([], dtype=object)]
+    for part in _clip_chunks(gdf, mask, chunk_rows, memory_limit_mb, clip_func):
+        positions.append(part.index.values)
+        geoms.append(np.asarray(part.geometry.values, dtype=object))
+    positions, geoms = np.concatenate(positions), np.concatenate(geoms)
+    order = np.argsort(positions, kind='stable')
+    result = gdf.iloc[positions[order]].copy()
+    result[gdf.geometry.name] = gpd.GeoSeries(geoms[order], index=result.index, crs=gdf.crs)
+    return result
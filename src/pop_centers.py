@@ -0,0 +1,122 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+
+class PopulationCenterIndex(object):
+    """
+    Population centers prepared once per run and shared by every stage that compares something with them
+    (CBGs, parcels, roads, POIs).
+
+    holds:
+        - gdf: the validated population centers (one row per center)
+        - union: the dissolved geometry of all centers, prepared for fast repeated predicates
+        - tree: an STRtree over the individual centers, used for bulk intersects/nearest queries
+        - bounds: (n, 4) array of the bounding boxes of the centers
+
+    All queries take a GeoDataFrame/GeoSeries (must be in the same CRS) or an array of shapely geometries and return
+    one value per input geometry.
+    """
+
+    def __init__(self, pop_center_gdf, union=None):
+        gdf = pop_center_gdf[~pop_center_gdf.geometry.is_empty & pop_center_gdf.geometry.notna()].copy()
+        gdf.geometry = gdf.geometry.make_valid()
+        self.gdf = gdf
+        self.crs = gdf.crs
+        self.geoms = np.asarray(gdf.geometry.values, dtype=object)
+        self.bounds = shapely.bounds(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        self.union = shapely.union_all(self.geoms) if union is None else union
+        shapely.prepare(self.union)
+
+    def __len__(self):
+        return len(self.geoms)
+
+    # -------------------------------------------------------------- cache
+    @staticmethod
+    def _cache_file(cache_dir, key):
+        return os.path.join(cache_dir, f'pop_center_index_{key}.pkl')
+
+    @classmethod
+    def load(cls, cache_dir, key):
+        """returns the cached index saved under `key`, or None if there is none"""
+        path = cls._cache_file(cache_dir, key)
+        if not os.path.exists(path):
+            return None
+        cached = pd.read_pickle(path)
+        print(f'---- \t loaded population center index from {path}')
+        # the tree and the prepared union are cheap to rebuild, only the dissolve is worth caching
+        return cls(cached['gdf'], union=cached['union'])
+
+    def save(self, cache_dir, key):
+        os.makedirs(cache_dir, exist_ok=True)
+        pd.to_pickle({'gdf': self.gdf, 'union': self.union}, self._cache_file(cache_dir, key))
+
+    # -------------------------------------------------------------- queries
+    def _as_array(self, geoms):
+        if isinstance(geoms, (gpd.GeoDataFrame, gpd.GeoSeries)):
+            if geoms.crs is not None and self.crs is not None and geoms.crs != self.crs:
+                raise ValueError(f'population center index is in {self.crs} but got geometries in {geoms.crs}')
+            geoms = geoms.geometry.values
+        return np.asarray(geoms, dtype=object)
+
+    def intersects(self, geoms):
+        """True where the geometry touches or overlaps any population center"""
+        geoms = self._as_array(geoms)
+        result = np.zeros(len(geoms), dtype=bool)
+        hits = self.tree.query(geoms, predicate='intersects')[0]
+        result[hits] = True
+        return result
+
+    def inside(self, geoms):
+        """True where the geometry is fully covered by the population centers"""
+        geoms = self._as_array(geoms)
+        result = self.intersects(geoms)
+        result[result] = shapely.covers(self.union, geoms[result])
+        return result
+
+    def outside(self, geoms):
+        """True where the geometry has nothing in common with the population centers"""
+        return ~self.intersects(geoms)
+
+    def crosses(self, geoms):
+        """True where the geometry is partly inside and partly outside the population centers"""
+        geoms = self._as_array(geoms)
+        result = self.intersects(geoms)
+        result[result] = ~shapely.covers(self.union, geoms[result])
+        return result
+
+    def distance(self, geoms):
+        """
+        distance (in CRS units) from each geometry to the nearest population center, and the position (row number
+        in self.gdf) of that center. Geometries that intersect a center have distance 0.
+        """
+        geoms = self._as_array(geoms)
+        (input_idx, tree_idx), dist = self.tree.query_nearest(geoms, return_distance=True, all_matches=False)
+        distance = np.full(len(geoms), np.nan)
+        nearest = np.full(len(geoms), -1, dtype=np.int64)
+        distance[input_idx] = dist
+        nearest[input_idx] = tree_idx
+        return distance, nearest
+
+    def difference(self, geoms):
+        """
+        the parts of the geometries outside the population centers. Only geometries that cross a center boundary
+        get an actual difference; fully outside ones are returned as is and fully inside ones become empty.
+        """
+        geoms = self._as_array(geoms)
+        result = geoms.copy()
+        touching = self.intersects(geoms)
+        inside = touching.copy()
+        inside[touching] = shapely.covers(self.union, geoms[touching])
+        crossing = touching & ~inside
+        result[inside] = shapely.Polygon()
+        result[crossing] = shapely.difference(geoms[crossing], self.union)
+        return result
+
+    def dissolved(self):
+        """all centers as a single row GeoDataFrame, e.g. for Erase_analysis in the ArcGIS steps"""
+        return gpd.GeoDataFrame(geometry=[self.union], crs=self.crs)
@@ -2,19 +2,33 @@ import os
 
 import geopandas as gpd
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import pygris
-from shapely.geometry import Polygon, MultiPolygon, GeometryCollection
-from shapely.ops import unary_union
-from shapely.validation import make_valid
+import shapely
 
-from .utils import _save_geopackage, _polygon_to_multipolygon, _geomcollection_to_multipolygon
+from .fields import parcel_county_field, parcel_id_fields
+from .ingest import check_crs, read_projected
+from .overlay import chunked_clip, iter_overlay
+from .pop_centers import PopulationCenterIndex
+from .units import METERS_PER_MILE
+from .utils import (OutputWriter, TaskScheduler, _save_geopackage, _hash_rows, _hash_geometries, _file_fingerprint,
+                    _to_multipolygons, _clip_to_mask)
+from .water import erase_water, read_area_water
 
 
 landuse_code_field = 'LANDUSE_CD'
+parcel_state_filename = 'parcels_state.pkl'  # row hashes of the last parcel run, used by incremental mode
 CRS = 32610
-# todo check the order of .to_crs functions
+# working memory (MB) for the big overlay/clip steps. None does each of them in one go; with a number, the left
+# layer is processed in spatial chunks that fit in it (see src/overlay.py)
+overlay_memory_limit_mb = None
+# edges (miles) of the distance bands to the nearest population center: 0-1, 1-3, 3-5 and >5 miles
+distance_bands_mi = [1, 3, 5]
+# relative number of residents per parcel for each residential land use code, used to spread CBG population over
+# its parcels: 11 single family, 12 two to four units, 13 five or more units, 14 condominium (one parcel per unit,
+# so stacked condos already count once per unit), 15 mobile home park
+residential_weights = {11: 1.0, 12: 3.0, 13: 10.0, 14: 1.0, 15: 5.0}
+# CBG column -> parcel column that receives its allocated share
+allocated_columns = {'TotPop': 'ALLOC_POP', 'CountHU': 'ALLOC_HU'}
 sld_selected_columns = ['GEOID10', 'CSA_Name', 'CBSA_Name', 'Ac_Land', 'Ac_Unpr', 'Ac_Water', 'TotPop', 'CountHU',
                         'HH', 'P_WrkAge', 'White', 'Male', 'Residents', 'Drivers', 'Vehicles', 'GasPrice', 'Pct_AO0',
                         'R_LowWageWk', 'R_MedWageWk', 'R_HiWageWk', 'R_PCTLOWWAGE', 'E_LowWageWk', 'E_MedWageWk',
@@ -28,15 +42,39 @@ columns_to_keep = [
 
 
 
-def _custom_summary(x):
-    return pd.Series({
-        "N": x.count(),
-        "Q1": x.quantile(0.25),
-        "Q3": x.quantile(0.75),
-        "Mean": x.mean(),
-        "SD": x.std(),
-        "Median [Min, Max]": f"{x.median():.2f} [{x.min():.2f}, {x.max():.2f}]"
-    })
+summary_stats = ['N', 'Q1', 'Median', 'Q3', 'Mean', 'SD', 'Min', 'Max']
+summary_group_columns = ['LOCALE', 'LowWage_Combined_home_work', 'COUNTYFP']
+
+
+def _numeric_summary(df, columns, by):
+    """
+    N, quartiles, mean, SD, min and max of every column in every group, computed with one grouped aggregation per
+    statistic (no python code per group). Values stay numeric; formatting is left to the export functions.
+    :return: data frame indexed by the group keys, with (column, stat) MultiIndex columns
+    """
+    grouped = df.groupby(by, observed=True)[columns]
+    quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack(level=-1)
+    stats = {
+        'N': grouped.count(),
+        'Q1': quartiles.xs(0.25, axis=1, level=-1),
+        'Median': quartiles.xs(0.5, axis=1, level=-1),
+        'Q3': quartiles.xs(0.75, axis=1, level=-1),
+        'Mean': grouped.mean(),
+        'SD': grouped.std(),
+        'Min': grouped.min(),
+        'Max': grouped.max(),
+    }
+    summary = pd.concat(stats, axis=1).swaplevel(axis=1)
+    return summary.reindex(columns=pd.MultiIndex.from_product([columns, summary_stats]))
+
+
+def _format_summary(summary, column):
+    """the layout of the original R table for one column: stats as rows, groups as columns"""
+    s = summary[column]
+    table = s[['N', 'Q1', 'Q3', 'Mean', 'SD']].astype(object)
+    table["Median [Min, Max]"] = (s['Median'].map('{:.2f}'.format) + ' [' + s['Min'].map('{:.2f}'.format) + ', ' +
+                                  s['Max'].map('{:.2f}'.format) + ']')
+    return table.T
 
 
 def _categorical_summary(df, col4rows, col4columns):
@@ -52,15 +90,27 @@ def _categorical_summary(df, col4rows, col4columns):
     return combined
 
 
-def get_study_area(state, counties, save_map_path=None):
-    print("\n---- loading study area")
+def get_state_counties(state):
+    import pygris  # imported here since it is only needed for this download and is slow to import
     # Get TIGER/Line file for counties in a specific state
-    state_counties = pygris.counties(state = state, cb=True, year=2023)
     # using cb=True we can exclude water bodies to some extent
+    return pygris.counties(state = state, cb=True, year=2023)
+
+
+def get_study_area(state, counties, save_map_path=None, state_counties=None):
+    """
+    :param state_counties: counties of the state if already loaded (see load_base_layers), otherwise they are
+        downloaded with pygris
+    """
+    print("\n---- loading study area")
+    if state_counties is None:
+        state_counties = get_state_counties(state).to_crs(CRS)
+    check_crs(state_counties, CRS, 'get_study_area')
     studyarea = state_counties[state_counties["NAME"].isin(counties)]
     state_FIPS = studyarea.STATEFP.iloc[0]
 
     if save_map_path:
+        import matplotlib.pyplot as plt  # optional, only needed for saving the map
         fig, ax = plt.subplots(figsize=(8, 8))
         studyarea.plot(ax=ax, facecolor="white", edgecolor="gray")
         for _, row in studyarea.iterrows():
@@ -79,41 +129,62 @@ def get_study_area(state, counties, save_map_path=None):
         plt.title(f"{state} Study Area Counties")
         plt.savefig(save_map_path)
         print("---- \t map saved to {}".format(save_map_path))
-    return studyarea, state_FIPS  # original code
-    # return studyarea.to_crs(CRS), state_FIPS
+    return studyarea, state_FIPS
 
 
-def get_smart_location_db(database_path, state_fips, database_layer="EPA_SLD_Database_V3"):
+def get_smart_location_db(database_path, state_fips, database_layer="EPA_SLD_Database_V3", mask=None,
+                          cache_dir=None):
+    """
+    :param database_path: SLD geodatabase, or a partitioned store of it (see spatial_store)
+    :param mask: study area. Only the CBGs around it are read (see ingest.read_projected)
+    """
     print("\n---- loading EPA smart location database for state_fips={}".format(state_fips))
-    US_SLD_CBG = gpd.read_file(database_path, layer=database_layer)
+    US_SLD_CBG = read_smart_location_db(database_path, database_layer=database_layer, mask=mask, cache_dir=cache_dir)
+    return _select_state(US_SLD_CBG, state_fips)
+
+
+def read_smart_location_db(database_path, database_layer="EPA_SLD_Database_V3", mask=None, cache_dir=None):
+    """the SLD layer (all states, or the CBGs around mask) in CRS, see get_smart_location_db"""
+    print(f"\n---- reading EPA smart location database from {database_path}")
+    return read_projected(database_path, CRS, layer=database_layer, mask=mask, cache_dir=cache_dir)
+
+
+def _select_state(SLD_gdf, state_fips):
     # filter selected state only (example: WA = 53)
-    state_SLD_CBG = US_SLD_CBG[US_SLD_CBG["STATEFP"] == state_fips]
-    return state_SLD_CBG
+    return SLD_gdf[SLD_gdf["STATEFP"] == state_fips]
 
 
 def filter_CBGs_by_area_and_columns(SLD_gdf, studyarea_gdf):
-    SLD_gdf = SLD_gdf.to_crs(studyarea_gdf.crs)
+    check_crs(SLD_gdf, CRS, 'filter_CBGs_by_area_and_columns')
+    check_crs(studyarea_gdf, CRS, 'filter_CBGs_by_area_and_columns')
     # filter CBGs based on county code and land area
     study_CBGs = SLD_gdf[SLD_gdf['COUNTYFP'].isin(studyarea_gdf['COUNTYFP'])]
-    # Remove water from geometries as much as possible  TODO can we do better?
+    # Remove water from geometries as much as possible. The rest of the water is erased later with an area water
+    # layer if one is given (see src/water.py)
     study_CBGs = study_CBGs[study_CBGs['Ac_Land'] > 0]
-    study_CBGs = gpd.clip(study_CBGs, studyarea_gdf)
+    study_CBGs = _clip_to_mask(study_CBGs, studyarea_gdf)
     #todo remove it or keep it? if remove, results of this file will be identical with Panick's R file
     # remove water from land by clipping (NEW** not present in R file)
     # we can do this because we had cb=True in pygris.counties(state = state_in, cb=True, year=2023)
     # turn everything into MultiPolygon.
     print(f'\n---- loaded {len(study_CBGs)} census block groups in the following '
           f'core-based statistical areas: {study_CBGs["CBSA_Name"].unique()}')
-    _polygon_to_multipolygon(study_CBGs)
+    study_CBGs = _to_multipolygons(study_CBGs)
     study_CBGs = study_CBGs.loc[:, sld_selected_columns]
     return study_CBGs
 
 
-def filter_CBGs_by_pop_center(CBG_gdf, pop_center_gdf):
+def filter_CBGs_by_pop_center(CBG_gdf, pop_center_index):
+    """
+    :param pop_center_index: PopulationCenterIndex (a geo dataframe of population centers also works, but then the
+        index is built here and thrown away)
+    """
     print(f'\n---- Interescting census block groups and population centers')
+    if not isinstance(pop_center_index, PopulationCenterIndex):
+        pop_center_index = PopulationCenterIndex(pop_center_gdf=pop_center_index)
     # Let see the CBGs that do not intersect population centers
-    # Find intersections
-    CBG_gdf['intersects_w_pop_center'] = CBG_gdf.geometry.apply(lambda x: pop_center_gdf.intersects(x).any())
+    # Find intersections (one bulk query on the index instead of one intersects() per CBG)
+    CBG_gdf['intersects_w_pop_center'] = pop_center_index.intersects(CBG_gdf)
 
     # Keep only those that do NOT intersect
     CBGs_outside = CBG_gdf[CBG_gdf.intersects_w_pop_center == False]
@@ -133,36 +204,32 @@ def filter_CBGs_by_pop_center(CBG_gdf, pop_center_gdf):
     # diff.explore()  # if we look at the map, there will be super small polygons, on Seattle for example,
     # # that are not in the R file and the original example
     ## 2- The other way is to exactly replicate the R file  --------------------------------------------------------------
-    pop_union = unary_union(pop_center_gdf.geometry)  # Union all population centers into one geometry
+    # the index holds the union of all population centers, so we don't dissolve them again here
     CBGs_outside_PCs = CBGs_with_PCs.copy()
     # CBGs_outside_PCs = study_CBGs[CBGs_with_PCs.intersects_w_pop_center==True].to_crs(32610)
     # if we use this which is the study CBGs with water, we can get exactly 1335 rows
-    CBGs_outside_PCs["geometry"] = CBGs_outside_PCs.geometry.difference(pop_union)
+    CBGs_outside_PCs["geometry"] = pop_center_index.difference(CBGs_outside_PCs)
     # Geometric difference: keep only the "outside" part
-    # This line removes non polygons from geometrycollection entries
-    CBGs_outside_PCs = CBGs_outside_PCs[~CBGs_outside_PCs.geometry.is_empty]  # this results in a similar map with 1333 rows.
+    # empty results (this results in a similar map with 1333 rows), lines and points left in geometryCollection
+    # entries are removed and everything is kept as MultiPolygons, all in one vectorized pass
     # if we use: WA_CBG_outside_PCs = study_CBGs[WA_SLD_study.intersects_w_pop_center==True].to_crs(32610)
     # which is the study CBGs with water, we can get exactly 1335 rows
-    # if we get geometryCollection entries (which may contain lines) we remove those lines and only keep polygons
-    mask = CBGs_outside_PCs.geometry.type == 'GeometryCollection'
-    CBGs_outside_PCs.loc[mask, "geometry"] = (
-        CBGs_outside_PCs.loc[mask, "geometry"].apply(_geomcollection_to_multipolygon)
-    )
-    WA_CBG_outside_PCs = CBGs_outside_PCs[~CBGs_outside_PCs.geometry.is_empty]
-    # now let's keep everything as MultiPolygons
-    _polygon_to_multipolygon(WA_CBG_outside_PCs)
+    WA_CBG_outside_PCs = _to_multipolygons(CBGs_outside_PCs)
     print(f'----\t {len(WA_CBG_outside_PCs)} census block groups intersect with population centers, but not fully '
           f'(Attention: there are still some CBGs that their land fully intersects with population centers but are'
           f'still counted here for their water portions)')
 
-    return CBGs_outside_PCs, CBGs_with_PCs, CBGs_outside
+    return WA_CBG_outside_PCs, CBGs_with_PCs, CBGs_outside
+
+
+def _largest_intersection(intersection_gdf):
+    intersection_gdf = pd.DataFrame(intersection_gdf[['GEOID10', 'LOCALE']]).assign(area=intersection_gdf.area)
+    return intersection_gdf.sort_values('area', ascending=False).drop_duplicates(subset='GEOID10', keep='first')
 
 
 def filter_CBGs_by_area_type(CBG_gdf, area_type_gdf):
     print(f'\n---- Filtering CBGs by their area type (city, suburban, town, rural)')
-    # Ensure both GeoDataFrames use the same Coordinate Reference System (CRS)
-    if CBG_gdf.crs != area_type_gdf.crs:
-        area_type_gdf = area_type_gdf.to_crs(CBG_gdf.crs)
+    check_crs(area_type_gdf, CBG_gdf.crs, 'filter_CBGs_by_area_type')
     # Fix any invalid geometries to prevent errors during intersection
     CBG_gdf.geometry = CBG_gdf.geometry.make_valid()
     area_type_gdf.geometry = area_type_gdf.geometry.make_valid()
@@ -171,12 +238,16 @@ def filter_CBGs_by_area_type(CBG_gdf, area_type_gdf):
 
     # R: sf::sf_use_s2(FALSE)
     # Note: This is not needed in Geopandas, which uses a planar geometry engine by default.
-    intersection_gdf = gpd.overlay(CBG_gdf, area_type_gdf, how='intersection')
-    intersection_gdf['area'] = intersection_gdf.geometry.area
-    # Find the row with the largest area for each GEOID10
+    if overlay_memory_limit_mb is None:
+        pieces = [gpd.overlay(CBG_gdf, area_type_gdf, how='intersection')]
+    else:
+        # chunks of the intersection are reduced as they come, the whole intersection is never in memory
+        pieces = iter_overlay(CBG_gdf, area_type_gdf, how='intersection', memory_limit_mb=overlay_memory_limit_mb)
+    # Find the row with the largest area for each GEOID10 (of each chunk, then of all chunk winners)
     # A common pandas method is to sort and drop duplicates.
-    intersection_gdf = intersection_gdf.sort_values('area', ascending=False)
-    largest_intersection_df = intersection_gdf.drop_duplicates(subset='GEOID10', keep='first')
+    largest_intersection_df = pd.concat([_largest_intersection(piece) for piece in pieces])
+    largest_intersection_df = largest_intersection_df.sort_values('area', ascending=False, kind='stable')
+    largest_intersection_df = largest_intersection_df.drop_duplicates(subset='GEOID10', keep='first')
     # We only need the key and the column to be merged ('GEOID10', 'LOCALE', and 'area' for the next step)
     # This mimics the creation of 'largest_intersection_df' in R.
     largest_intersection_df = largest_intersection_df[['GEOID10', 'LOCALE', 'area']].rename(
@@ -216,6 +287,110 @@ def filter_CBGs_by_area_type(CBG_gdf, area_type_gdf):
     return CBG_gdf
 
 
+def _band_labels(edges):
+    bounds = [0] + list(edges)
+    return [f'{low:g}-{high:g}' for low, high in zip(bounds[:-1], bounds[1:])] + [f'>{bounds[-1]:g}']
+
+
+def add_distance_bands(gdf, pop_center_index, bands_mi=None):
+    """
+    distance from every feature to the nearest population center, which center that is, and the distance band it
+    falls in. One bulk nearest query on the index for all features. Distances are measured from a point inside each
+    feature (representative_point), so CBG pieces that touch a center still get a distance that shows how far they
+    reach out of it.
+    Adds PC_DIST_MI, PC_NEAR_ID (index label of the nearest center in pop_center_index.gdf) and PC_BAND (ordered
+    categories like '0-1', '1-3', '3-5', '>5'; the upper edge belongs to the band)
+    :param bands_mi: band edges in miles (default: distance_bands_mi)
+    """
+    edges = sorted(bands_mi or distance_bands_mi)
+    labels = _band_labels(edges)
+    distance, nearest = pop_center_index.distance(gdf.geometry.representative_point())
+    distance_mi = distance / METERS_PER_MILE
+    found = nearest >= 0
+    band = np.searchsorted(edges, distance_mi, side='left')
+    nearest_id = pd.Series(pop_center_index.gdf.index.values[np.where(found, nearest, 0)]).where(found)
+    return gdf.assign(
+        PC_DIST_MI=distance_mi.round(3),
+        PC_NEAR_ID=nearest_id.values,
+        PC_BAND=pd.Categorical.from_codes(np.where(found, band, -1), categories=labels, ordered=True),
+    )
+
+
+def distance_band_summary(layers):
+    """
+    how many features of each layer fall in each distance band, and the population / housing units (and distinct
+    parcel footprints) where the layer has them. Lets different "right outside" definitions be compared from one run.
+    :param layers: {name: frame with PC_BAND (see add_distance_bands)}
+    """
+    tables = {}
+    for name, df in layers.items():
+        grouped = df.groupby('PC_BAND', observed=False)
+        table = grouped.size().to_frame('count')
+        for column in ['TotPop', 'CountHU', 'RURAL_POP', 'RURAL_HU', 'ALLOC_POP', 'ALLOC_HU']:
+            if column in df.columns:
+                table[column] = grouped[column].sum()
+        if 'units_per_footprint' in df.columns:
+            # stacked parcels (condos) are one row per unit and every row has the unit count of its footprint, so
+            # each footprint adds up to one
+            table['footprints'] = (1 / df['units_per_footprint']).groupby(df['PC_BAND'], observed=False).sum()
+        tables[name] = table
+    return pd.concat(tables, axis=1)
+
+
+def allocate_to_parcels(parcel_gdf, CBG_gdf, weights=None, columns=None):
+    """
+    dasymetric allocation of CBG totals (population, housing units) to the residential parcels of the CBG.
+    Each parcel gets the GEOID10 of the CBG that contains its representative point (nearest CBG if none does, e.g.
+    after water erasure), and a share of the CBG totals proportional to its land use weight. Everything is done with
+    array operations over all parcels (np.bincount per CBG), no loop over parcels or CBGs.
+    :param weights: {land use code: weight} (default: residential_weights)
+    :param columns: {CBG column: parcel column} (default: allocated_columns)
+    :return: the parcels with GEOID10 and one column per allocated CBG column
+    """
+    weights = weights or residential_weights
+    columns = columns or allocated_columns
+    if parcel_gdf.crs != CBG_gdf.crs:
+        raise ValueError(f'parcels are in {parcel_gdf.crs} but CBGs are in {CBG_gdf.crs}')
+    print(f'\n---- Allocating {list(columns)} of {len(CBG_gdf)} CBGs to {len(parcel_gdf)} residential parcels')
+    points = np.asarray(parcel_gdf.geometry.representative_point().values, dtype=object)
+    tree = shapely.STRtree(np.asarray(CBG_gdf.geometry.values, dtype=object))
+    host = np.full(len(points), -1, dtype=np.int64)
+    parcel_i, cbg_j = tree.query(points, predicate='intersects')
+    # a point on a shared boundary intersects two CBGs, keep the first one
+    parcel_i, first = np.unique(parcel_i, return_index=True)
+    host[parcel_i] = cbg_j[first]
+    outside = np.flatnonzero(host < 0)
+    if len(outside):
+        nearest_i, nearest_j = tree.query_nearest(points[outside], all_matches=False)
+        host[outside[nearest_i]] = nearest_j
+
+    weight = parcel_gdf[landuse_code_field].astype(int).map(weights).fillna(0).to_numpy(float)
+    total_weight = np.bincount(host, weights=weight, minlength=len(CBG_gdf))
+    share = np.divide(weight, total_weight[host], out=np.zeros(len(weight)), where=total_weight[host] > 0)
+    allocated = {'GEOID10': CBG_gdf['GEOID10'].to_numpy()[host]}
+    for cbg_column, parcel_column in columns.items():
+        allocated[parcel_column] = CBG_gdf[cbg_column].to_numpy(float)[host] * share
+        lost = CBG_gdf[cbg_column].to_numpy(float)[total_weight == 0].sum()
+        print(f'---- \t {cbg_column}: {allocated[parcel_column].sum():.0f} allocated, {lost:.0f} in CBGs without '
+              f'residential parcels')
+    return parcel_gdf.assign(**allocated)
+
+
+def add_rural_totals(CBG_gdf, parcels_out_pc):
+    """
+    population and housing units of each CBG that live outside population centers, from the allocated parcel values
+    (see allocate_to_parcels). Adds RURAL_POP, RURAL_HU and PCT_RURAL (share of TotPop).
+    """
+    totals = parcels_out_pc.groupby('GEOID10')[['ALLOC_POP', 'ALLOC_HU']].sum()
+    totals = totals.reindex(CBG_gdf['GEOID10'], fill_value=0)
+    rural_pop = totals['ALLOC_POP'].to_numpy()
+    return CBG_gdf.assign(
+        RURAL_POP=rural_pop.round(1),
+        RURAL_HU=totals['ALLOC_HU'].to_numpy().round(1),
+        PCT_RURAL=(100 * rural_pop / CBG_gdf['TotPop'].where(CBG_gdf['TotPop'] > 0)).round(1),
+    )
+
+
 def add_income_to_CBGs(SLD_CBG_gdf):
     # LowWage_Category_Home
     median_low_wage_home = SLD_CBG_gdf["R_PCTLOWWAGE"].median(skipna=True)
@@ -233,30 +408,51 @@ def add_income_to_CBGs(SLD_CBG_gdf):
                                                     )
     SLD_CBG_gdf['LowWage_Combined_home_work'] = (SLD_CBG_gdf["LowWage_Category_Home"].astype(str) + "_" +
                                                  SLD_CBG_gdf["LowWage_Category_Work"].astype(str))
-    SLD_CBG_gdf = SLD_CBG_gdf.to_crs(CRS)
     return SLD_CBG_gdf
 
 
-def read_population_centers(database_path):
+def read_population_centers(database_path, mask=None, cache_dir=None):
     '''
     This out layer assists WSDOT in prioritizing active transportation improvements in areas where people congregate
      and access destinations, and where travel distances between destinations align with typical distances travelled
      by users of pedestrian and bicycle modes. These areas are a priority because they serve the broadest range of users
     and potential users of the transportation system, including the very young, very old, and people with disabilities.
-    :param database_path: address of the dataset
-    :return: geo dataframe of pop centers
+    :param database_path: address of the dataset (file or partitioned store)
+    :param mask: study area. Only the centers around it are read (see ingest.read_projected)
+    :param cache_dir: folder for the projected copy of the layer
+    :return: geo dataframe of pop centers in CRS
     '''
     print(f'\n---- Reading population centers from {database_path}')
-    population_centers = gpd.read_file(database_path)
-    population_centers = population_centers.to_crs(CRS)
-    return population_centers
+    return read_projected(database_path, CRS, mask=mask, cache_dir=cache_dir)
+
+
+def load_population_center_index(pop_ctr_path, study_CBGs, cache_dir=None, population_centers=None):
+    """
+    reads the population centers, clips them to the study CBGs and builds the PopulationCenterIndex that every later
+    stage uses. With a cache_dir, the index is saved there and reused as long as the population center file and the
+    study CBGs are the same.
+    :param population_centers: already loaded population centers (see load_base_layers), skips reading the file
+    """
+    key = None
+    if cache_dir:
+        key = f'{_file_fingerprint(pop_ctr_path)}_{int(_hash_rows(study_CBGs[["geometry"]]).sum()):x}'
+        pc_index = PopulationCenterIndex.load(cache_dir, key)
+        if pc_index is not None:
+            return pc_index
+    if population_centers is None:
+        population_centers = read_population_centers(pop_ctr_path, mask=study_CBGs, cache_dir=cache_dir)
+    check_crs(population_centers, study_CBGs.crs, 'load_population_center_index')
+    # population centers within the study area
+    pc_index = PopulationCenterIndex(_clip_to_mask(population_centers, study_CBGs))
+    if cache_dir:
+        pc_index.save(cache_dir, key)
+    return pc_index
 
 
-def read_area_type_data(nces_path):
+def read_area_type_data(nces_path, mask=None, cache_dir=None):
     print(f'\n---- Reading area type data (EDGE Locale dataset) from {nces_path}')
 
-    nces_0 = gpd.read_file(nces_path)
-    nces_0 = nces_0.to_crs(CRS)
+    nces_0 = read_projected(nces_path, CRS, mask=mask, cache_dir=cache_dir)
     area_type = nces_0.copy()
     area_type["LOCALE"] = area_type["LOCALE"].astype(int)
     # Define conditions
@@ -274,15 +470,10 @@ def read_area_type_data(nces_path):
 
 
 def export_summary_statistics(CBG_gdf):
-    result = {}
-    for col in ["R_PCTLOWWAGE", "E_PctLowWage"]:
-        summary = (
-            CBG_gdf
-            .groupby("LowWage_Combined_home_work", observed=True)[col]
-            .apply(_custom_summary)
-            .unstack(level=0)  # groups (Above/Below Median) become columns
-        )
-        result[col] = summary
+    columns = ["R_PCTLOWWAGE", "E_PctLowWage"]
+    summary = _numeric_summary(CBG_gdf, columns, "LowWage_Combined_home_work")
+    # groups (Above/Below Median) become columns
+    result = {col: _format_summary(summary, col) for col in columns}
 
     locale_summary = _categorical_summary(CBG_gdf, "LOCALE", "LowWage_Combined_home_work")
 
@@ -290,11 +481,66 @@ def export_summary_statistics(CBG_gdf):
     return descript_summary
 
 
-def save_files(save_dir, descript_summary, studyarea, study_CBGs, CBG_outside_pc_gdf, CBG_outside_gdf, population_centers_study_area):
+def export_grouped_summary(CBG_gdf, columns=None, by=None):
+    """
+    descriptive statistics of every numeric SLD field for every LOCALE x low wage category x county combination.
+    :param columns: columns to summarize (default: the numeric columns of sld_selected_columns)
+    :param by: grouping columns (default: summary_group_columns). COUNTYFP is taken from GEOID10 if missing.
+    :return: long table, one row per (group, column) and one column per statistic
+    """
+    df, columns, by = _summary_inputs(CBG_gdf, columns, by)
+    summary = _numeric_summary(df, columns, by)
+    summary = pd.concat({c: summary[c] for c in columns}, names=['column'])
+    return summary.reorder_levels(by + ['column']).sort_index()[summary_stats]
+
+
+def export_weighted_summary(CBG_gdf, weight='RURAL_POP', columns=None, by=None):
+    """
+    population-weighted means of the same fields and groups as export_grouped_summary: each CBG counts as much as
+    the people living in its part outside population centers (see add_rural_totals), instead of one.
+    :return: one row per group, with the total weight and the weighted mean of every column
+    """
+    df, columns, by = _summary_inputs(CBG_gdf, columns, by)
+    keys = [df[c] for c in by]
+    w = df[weight].fillna(0)
+    values = df[columns]
+    # missing values don't count in the weight of their column
+    weighted_sum = values.mul(w, axis=0).groupby(keys, observed=True).sum()
+    weight_sum = values.notna().mul(w, axis=0).groupby(keys, observed=True).sum()
+    summary = weighted_sum / weight_sum.where(weight_sum > 0)
+    summary.insert(0, weight, w.groupby(keys, observed=True).sum())
+    return summary.sort_index()
+
+
+def _summary_inputs(CBG_gdf, columns, by):
+    """attribute table, columns and group columns of the grouped summaries, with their defaults"""
+    by = list(by or summary_group_columns)
+    if 'COUNTYFP' in by and 'COUNTYFP' not in CBG_gdf.columns:
+        CBG_gdf = CBG_gdf.assign(COUNTYFP=CBG_gdf['GEOID10'].str[2:5])
+    if columns is None:
+        columns = [c for c in sld_selected_columns
+                   if c in CBG_gdf.columns and pd.api.types.is_numeric_dtype(CBG_gdf[c])]
+    return pd.DataFrame(CBG_gdf.drop(columns='geometry', errors='ignore')), columns, by
+
+
+def save_files(save_dir, descript_summary, studyarea, study_CBGs, CBG_outside_pc_gdf, CBG_outside_gdf,
+               population_centers_study_area, writer=None, pop_center_index=None, grouped_summary=None):
+    """
+    Queues all preprocessing outputs on `writer` (see utils.OutputWriter). If no writer is given, a local one is
+    created and flushed before returning, which gives the old blocking behaviour.
+    If pop_center_index is given, the dissolved population centers are also saved (used by the Erase steps of the
+    ArcGIS tool).
+    """
     print('\n ---- saving files:')
-    path = os.path.join(save_dir,'descript_category_0.xlsx')
-    descript_summary.to_excel(path)
-    print(f"saved {path}")
+    if writer is None:
+        with OutputWriter() as writer:
+            return save_files(save_dir, descript_summary, studyarea, study_CBGs, CBG_outside_pc_gdf,
+                              CBG_outside_gdf, population_centers_study_area, writer=writer,
+                              pop_center_index=pop_center_index, grouped_summary=grouped_summary)
+
+    writer.save_excel(descript_summary, os.path.join(save_dir, 'descript_category_0.xlsx'))
+    if grouped_summary is not None:
+        writer.save_excel(grouped_summary.round(3), os.path.join(save_dir, 'descript_numeric_by_group.xlsx'))
 
     # new -- not sure if make_valids are helpful
     studyarea.loc[:, 'geometry'] = studyarea.geometry.make_valid()
@@ -303,93 +549,336 @@ def save_files(save_dir, descript_summary, studyarea, study_CBGs, CBG_outside_pc
     CBG_outside_pc_gdf.loc[:, 'geometry'] = CBG_outside_pc_gdf.geometry.make_valid()
     CBG_outside_gdf.loc[:, 'geometry'] = CBG_outside_gdf.geometry.make_valid()
 
-    _save_geopackage(studyarea, save_dir, "studyarea.gpkg", driver="GPKG")
-    # print(f"saved study area data to studyarea.gpkg")
+    writer.save_geopackage(studyarea, save_dir, "studyarea.gpkg", driver="GPKG")
+    writer.save_geopackage(population_centers_study_area, save_dir,
+                           "POPULATION_CENTERS_STUDY_AREA.gpkg", driver="GPKG")
+    if pop_center_index is not None:
+        writer.save_geopackage(pop_center_index.dissolved(), save_dir,
+                               "POPULATION_CENTERS_DISSOLVED.gpkg", driver="GPKG")
+    writer.save_geopackage(study_CBGs, save_dir, "study_area_CBGs_INCOME.gpkg", driver="GPKG")
 
-    _save_geopackage(population_centers_study_area, save_dir,
-                     "POPULATION_CENTERS_STUDY_AREA.gpkg", driver="GPKG")
+    CBG_gdf_data_0 = CBG_outside_pc_gdf.drop(columns='geometry')
+    writer.save_excel(CBG_gdf_data_0, os.path.join(save_dir, 'CBG_outside_PCs_data_0.xlsx'), index=False)
+    CBG_outside_pc_data_1 = CBG_outside_pc_gdf[columns_to_keep].copy()
+    writer.save_excel(CBG_outside_pc_data_1, os.path.join(save_dir, 'CBG_outside_PCs_data_1.xlsx'), index=False)
+
+    writer.save_geopackage(CBG_outside_gdf, save_dir, "CBGs_NOT_INTERSECT_PCs.gpkg", driver='GPKG')
+    writer.save_geopackage(CBG_outside_pc_gdf, save_dir, "CBGs_RIGHT_OUTSIDE_PCs.gpkg", driver='GPKG')
+    writer.save_geopackage(CBG_outside_pc_gdf, os.path.join(save_dir, 'cbg_out_pc_shapefile'),
+                           "CBGs_RIGHT_OUTSIDE_PCs.shp")
+    # print('saved POPULATION_CENTERS_WA_AREA.gpkg, CBGs_NOT_INTERSECT_PCs.gpkg, CBGs_RIGHT_OUTSIDE_PCs.gpkg')
 
-    _save_geopackage(study_CBGs, save_dir, "study_area_CBGs_INCOME.gpkg", driver="GPKG")
 
+def load_base_layers(state_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, counties_in=None,
+                     water_path=None, cache_dir=None):
+    """
+    reads and projects the input layers that don't depend on the selected counties. The result can be kept in
+    memory and reused by several run_preprocess calls (see src/server.py).
+
+    The layers are loaded at the same time in a thread pool (see utils.TaskScheduler) and this function returns
+    right away. Getting a layer from the result waits for that layer only, so run_preprocess starts with the CBGs
+    while the parcels are still loading. Use the result in a `with` block (or call close()) to stop the threads.
+    Every layer is read around the study area and projected to CRS once (see src/ingest.py), so the reads wait for
+    the county download.
+
+    :param counties_in: if given, layers are only read around these counties. Leave it empty to load the whole
+        state.
+    :param water_path: optional area water layer or folder (e.g. TIGER AREAWATER), erased from the CBGs
+    :param cache_dir: folder for projected copies of the layers. A later call with the same inputs and counties
+        reads these copies instead of the sources
+    :return: TaskScheduler, a mapping of layer name -> layer
+    """
+    layers = TaskScheduler()
+    layers.set('pop_ctr_path', pop_ctr_path)
+    layers.set('state_name', state_in)
+    layers.add('state_counties', lambda: get_state_counties(state_in).to_crs(CRS))
+    layers.add('extent', _study_extent, counties_in, after=['state_counties'])
+
+    def read(name, func, path, **kwargs):
+        layers.add(name, lambda extent: func(path, mask=extent, cache_dir=cache_dir, **kwargs), after=['extent'])
+
+    read('SLD_CBGs', read_smart_location_db, sld_gdb_path)
+    layers.add('state_SLD_CBGs', lambda sld, extent: _select_state(sld, extent.STATEFP.iloc[0]),
+               after=['SLD_CBGs', 'extent'])
+    read('population_centers', read_population_centers, pop_ctr_path)
+    read('area_type', read_area_type_data, nces_path)
+    read('parcels', read_residential_parcels, parcel_path)
+    if water_path:
+        read('area_water', read_area_water, water_path, crs=CRS)
+    else:
+        layers.set('area_water', None)
+    return layers
+
+
+def _study_extent(state_counties, counties_in):
+    if counties_in:
+        return state_counties[state_counties["NAME"].isin(counties_in)]
+    return state_counties
+
+
+def run_preprocess(base, counties_in, save_path=None, incremental=False, distance_bands_mi=None):
+    """
+    the county-specific part of the preprocessing, on layers from load_base_layers. Does not modify `base`.
+    :param distance_bands_mi: edges of the distance bands to population centers (see add_distance_bands)
+    """
+    # outputs are written in background threads while the next stages run. Leaving the `with` block waits for
+    # all of them and re-raises any write error here.
+    with OutputWriter() as writer:
+        studyarea, state_FIPS = get_study_area(base['state_name'], counties_in,
+                                               state_counties=base['state_counties'])
+        study_CBGs = filter_CBGs_by_area_and_columns(base['state_SLD_CBGs'], studyarea)
+        if base.get('area_water') is not None:
+            study_CBGs = erase_water(study_CBGs, base['area_water'])
+        # the low-wage medians are taken over the CBGs that still have land after the water is erased
+        study_CBGs = add_income_to_CBGs(study_CBGs)
+        # population centers within the study area, built once and shared by the CBG and parcel stages
+        pc_index = load_population_center_index(base['pop_ctr_path'], study_CBGs,
+                                                cache_dir=os.path.join(save_path, 'cache') if save_path else None,
+                                                population_centers=base['population_centers'])
+        pop_centers_study_area = pc_index.gdf
+        study_CBGs_outside_PCs, study_CBGs_with_PCs, study_CBGs_outside = (
+            filter_CBGs_by_pop_center(study_CBGs, pc_index)
+        )
+        # now we find the area type of each CBG that intersects with population centers
+        study_CBGs_outside_PCs = filter_CBGs_by_area_type(study_CBGs_outside_PCs, base['area_type'].copy())
+        study_CBGs_outside_PCs = add_distance_bands(study_CBGs_outside_PCs, pc_index, distance_bands_mi)
+        study_CBGs_outside = add_distance_bands(study_CBGs_outside, pc_index, distance_bands_mi)
+
+        # this was not part of the original R file. It runs before the CBG outputs are saved since the CBGs get
+        # the population of their parcels outside population centers
+        parcels_out_pc = preprocess_parcels(base['parcels'], studyarea, pc_index, save_path, writer=writer,
+                                            incremental=incremental, distance_bands_mi=distance_bands_mi,
+                                            CBG_gdf=study_CBGs)
+        study_CBGs_outside_PCs = add_rural_totals(study_CBGs_outside_PCs, parcels_out_pc)
+        study_CBGs_outside = add_rural_totals(study_CBGs_outside, parcels_out_pc)
+
+        descript_summary = export_summary_statistics(study_CBGs_outside_PCs)
+        grouped_summary = export_grouped_summary(study_CBGs_outside_PCs)
+        if save_path:
+            save_files(save_path, descript_summary, studyarea, study_CBGs, study_CBGs_outside_PCs,
+                       study_CBGs_outside, pop_centers_study_area, writer=writer, pop_center_index=pc_index,
+                       grouped_summary=grouped_summary)
+            writer.save_excel(export_weighted_summary(study_CBGs_outside_PCs).round(3),
+                              os.path.join(save_path, 'descript_numeric_pop_weighted.xlsx'))
+            band_summary = distance_band_summary({'CBGs_RIGHT_OUTSIDE_PCs': study_CBGs_outside_PCs,
+                                                  'CBGs_NOT_INTERSECT_PCs': study_CBGs_outside,
+                                                  'parcels_out_pc': parcels_out_pc})
+            writer.save_excel(band_summary, os.path.join(save_path, 'distance_bands_summary.xlsx'))
+        # todo: comment it if you don't want to create the file again. later, write a code that runs this
+        #  if the parcel_filtered file is not already written
+
+
+def preprocess(state_in, counties_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, save_path=None,
+               incremental=False, water_path=None, distance_bands_mi=None):
+    with load_base_layers(state_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, counties_in=counties_in,
+                          water_path=water_path,
+                          cache_dir=os.path.join(save_path, 'cache') if save_path else None) as base:
+        run_preprocess(base, counties_in, save_path=save_path, incremental=incremental,
+                       distance_bands_mi=distance_bands_mi)
+
+
+def _footprint_ids(parcel_gdf):
+    """
+    condos and other stacked parcels repeat the same footprint. Parcels get the same id when their normalized
+    geometries are the same.
+    :return: np.ndarray, one footprint id (0..number of footprints - 1) per parcel
+    """
+    return pd.factorize(_hash_geometries(parcel_gdf.geometry.values))[0]
+
+
+def _broadcast_footprints(parcel_gdf, footprint_id, footprint_gdf):
+    """parcels whose footprint is still in footprint_gdf (indexed by footprint id), with the footprint geometry"""
+    has_footprint = np.isin(footprint_id, footprint_gdf.index)
+    parcels = parcel_gdf[has_footprint].copy()
+    parcels[parcel_gdf.geometry.name] = gpd.GeoSeries(footprint_gdf.geometry.loc[footprint_id[has_footprint]].values,
+                                                      index=parcels.index, crs=footprint_gdf.crs)
+    return parcels
+
+
+def _prepare_parcel_geometries(parcel_gdf, studyarea, pc_index, footprint_id=None):
+    """
+    the per-parcel geometry work of preprocess_parcels: validating geometries, clipping to the study area and
+    removing the parts inside population centers. Works on any subset of parcels, which is what lets the
+    incremental mode reprocess only changed parcels.
+    The work is done once per footprint (see _footprint_ids) and the results are copied to every parcel of the
+    footprint.
+    :param footprint_id: footprint ids of the parcels if already computed
+    :return: (parcels in the study area, parcels in the study area but outside population centers)
+    """
+    if footprint_id is None:
+        footprint_id = _footprint_ids(parcel_gdf)
+    # footprint ids of a subset are not consecutive, number them again from 0
+    _, first, footprint_id = np.unique(footprint_id, return_index=True, return_inverse=True)
+    footprints = gpd.GeoDataFrame(geometry=parcel_gdf.geometry.values[first], crs=parcel_gdf.crs)
+    print(f'---- \t {len(parcel_gdf)} parcels have {len(footprints)} unique footprints')
 
-    path = os.path.join(save_dir, 'CBG_outside_PCs_data_0.xlsx')
-    CBG_gdf_data_0 = CBG_outside_pc_gdf.drop(columns='geometry')
-    CBG_gdf_data_0.to_excel(path, index=False)
-    print(f"saved data to {path}")
-
-    path = os.path.join(save_dir, 'CBG_outside_PCs_data_1.xlsx')
-    CBG_outside_pc_data_1 = CBG_outside_pc_gdf[columns_to_keep]
-    CBG_outside_pc_data_1.to_excel(path, index=False)
-    print(f"saved subsetted data to CBG_outside_PCs_data_1.xlsx")
-
-    _save_geopackage(CBG_outside_gdf, save_dir, "CBGs_NOT_INTERSECT_PCs.gpkg", driver='GPKG')
-    _save_geopackage(CBG_outside_pc_gdf, save_dir, "CBGs_RIGHT_OUTSIDE_PCs.gpkg", driver='GPKG')
-    _save_geopackage(CBG_outside_pc_gdf, os.path.join(save_dir, 'cbg_out_pc_shapefile'),
-                     "CBGs_RIGHT_OUTSIDE_PCs.shp")
-    # print('saved POPULATION_CENTERS_WA_AREA.gpkg, CBGs_NOT_INTERSECT_PCs.gpkg, CBGs_RIGHT_OUTSIDE_PCs.gpkg')
+    print('making the geometery valid (remove if the file works fine)')
+    footprints = _to_multipolygons(footprints, make_valid=True)
+    print('removing parcels that are outside of studyarea')
+    footprints_in_cbg = _to_multipolygons(chunked_clip(footprints, studyarea,
+                                                       memory_limit_mb=overlay_memory_limit_mb))
+
+    print('removing parcels that are inside pop centers')
+    # the index only computes a difference for parcels crossing a pop center boundary. Parcels fully outside are
+    # kept as they are and parcels fully inside are dropped without any geometry work
+    footprints_out_pc = footprints_in_cbg.copy()
+    footprints_out_pc['geometry'] = pc_index.difference(footprints_out_pc)
+    footprints_out_pc = _to_multipolygons(footprints_out_pc)
+
+    return (_broadcast_footprints(parcel_gdf, footprint_id, footprints_in_cbg),
+            _broadcast_footprints(parcel_gdf, footprint_id, footprints_out_pc))
+
+
+def _parcel_run_context(studyarea, pc_index):
+    # if the study area or the population centers change, previous clipping results can't be reused
+    studyarea_hash = int(_hash_rows(studyarea[['geometry']]).sum())
+    pop_centers_hash = int(_hash_rows(pc_index.dissolved()).sum())
+    return f'{studyarea_hash:x}_{pop_centers_hash:x}'
+
+
+def _load_parcel_state(save_path, context):
+    state_path = os.path.join(save_path, parcel_state_filename)
+    prev_paths = [os.path.join(save_path, f) for f in ('parcels_in_studyarea.gpkg', 'parcels_out_pc.gpkg')]
+    if not all(os.path.exists(p) for p in [state_path] + prev_paths):
+        print('---- \t no previous parcel run found, processing all parcels')
+        return None
+    state = pd.read_pickle(state_path)
+    if state.get('context') != context:
+        print('---- \t study area or population centers changed since the previous parcel run, '
+              'processing all parcels')
+        return None
+    return state['hashes'], gpd.read_file(prev_paths[0]), gpd.read_file(prev_paths[1])
+
+
+def _save_parcel_run(parcels_in_cbg_gdf, parcels_out_pc_gdf, hashes, context, save_path):
+    # the state is written after the geopackages so a failed write never leaves a state that points to stale outputs
+    _save_geopackage(parcels_in_cbg_gdf, save_path, 'parcels_in_studyarea.gpkg', driver='GPKG')
+    _save_geopackage(parcels_out_pc_gdf, save_path, 'parcels_out_pc.gpkg', driver='GPKG')
+    if hashes is not None:
+        pd.to_pickle({'context': context, 'hashes': hashes}, os.path.join(save_path, parcel_state_filename))
 
 
+def _diff_parcels(hashes, prev_hashes):
+    """compares {parcel id: row hash} of two runs. returns (added or changed ids, removed ids)"""
+    common = hashes.index.intersection(prev_hashes.index)
+    changed = common[hashes.loc[common].values != prev_hashes.loc[common].values]
+    added = hashes.index.difference(prev_hashes.index)
+    removed = prev_hashes.index.difference(hashes.index)
+    return added.append(changed), removed
 
-def preprocess(state_in, counties_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, save_path=None):
-    studyarea, state_FIPS = get_study_area(state_in, counties_in)
-    state_SLD_CBGs = get_smart_location_db(sld_gdb_path, state_FIPS)
-    study_CBGs = filter_CBGs_by_area_and_columns(state_SLD_CBGs, studyarea)
-    study_CBGs = add_income_to_CBGs(study_CBGs)
-    population_centers = read_population_centers(pop_ctr_path)
-    pop_centers_study_area = gpd.clip(population_centers, study_CBGs)
-    # population centers within the study area
-    study_CBGs_outside_PCs, study_CBGs_with_PCs, study_CBGs_outside = (
-        filter_CBGs_by_pop_center(study_CBGs, pop_centers_study_area)
-    )
-    area_type = read_area_type_data(nces_path)
-    # now we find the area type of each CBG that intersects with population centers
 
-    study_CBGs_outside_PCs = filter_CBGs_by_area_type(study_CBGs_outside_PCs, area_type)
+def _parcel_key_fields(parcel_gdf):
+    """
+    columns that identify a parcel: the county (if the layer has it) and the parcel id, under its full or its
+    shapefile name (see fields.parcel_id_fields). None if the layer has no parcel id.
+    """
+    id_field = next((f for f in parcel_id_fields if f in parcel_gdf.columns), None)
+    if id_field is None:
+        return None
+    return [parcel_county_field, id_field] if parcel_county_field in parcel_gdf.columns else [id_field]
 
-    descript_summary = export_summary_statistics(study_CBGs_outside_PCs)
-    if save_path:
-        save_files(save_path, descript_summary, studyarea, study_CBGs, study_CBGs_outside_PCs,
-                   study_CBGs_outside, pop_centers_study_area)
 
-    preprocess_parcels(parcel_path, studyarea, pop_centers_study_area, save_path)  # this was not part of the original R file
-    # todo: comment it if you don't want to create the file again. later, write a code that runs this
-    #  if the parcel_filtered file is not already written
+def _parcel_keys(parcel_gdf, key_fields):
+    """(county, parcel id) of every parcel as an index"""
+    return pd.MultiIndex.from_frame(pd.DataFrame(parcel_gdf[key_fields]))
 
 
+def _replace_parcels(prev_gdf, new_gdf, dropped_keys, key_fields):
+    kept = prev_gdf[~_parcel_keys(prev_gdf, key_fields).isin(dropped_keys)]
+    return pd.concat([kept, new_gdf[kept.columns.intersection(new_gdf.columns)]], ignore_index=True)
 
-def preprocess_parcels(parcels_path, studyarea, pop_centers, save_path):
-    print('\n---- Preparing residential parcels inside studyarea and validating their geometries')
-    parcel_gdf = gpd.read_file(parcels_path).to_crs(CRS)
+
+def _copy_allocation(parcels_in_cbg_gdf, parcels_out_pc_gdf, key_fields=None):
+    """allocated columns of the study area parcels copied to the same parcels outside population centers (matched
+    on `key_fields`, or by index when there are none)"""
+    columns = ['GEOID10'] + list(allocated_columns.values())
+    if key_fields:
+        source = parcels_in_cbg_gdf.set_axis(_parcel_keys(parcels_in_cbg_gdf, key_fields))
+        target = _parcel_keys(parcels_out_pc_gdf, key_fields)
+    else:
+        source, target = parcels_in_cbg_gdf, parcels_out_pc_gdf.index
+    return parcels_out_pc_gdf.drop(columns=columns, errors='ignore').assign(
+        **{c: source[c].reindex(target).to_numpy() for c in columns})
+
+
+def read_residential_parcels(parcels_path, mask=None, cache_dir=None):
+    parcel_gdf = read_projected(parcels_path, CRS, mask=mask, cache_dir=cache_dir)
     mask = parcel_gdf[landuse_code_field].isin([11, 12, 13, 14, 15])
-    parcel_gdf = parcel_gdf[mask]
-    print('making the geometery valid (remove if the file works fine)')
-    parcel_gdf.loc[:, 'geometry'] = parcel_gdf.geometry.make_valid()
-    print('removing parcels that are outside of studyarea')
-    parcels_in_cbg_gdf = gpd.clip(parcel_gdf, studyarea.to_crs(CRS))
-    _save_geopackage(parcels_in_cbg_gdf, save_path, 'parcels_in_studyarea.gpkg', driver='GPKG')
-    # parcels_in_cbg_gdf = gpd.read_file(os.path.join(save_path, 'parcels_in_studyarea.gpkg'))
-
-    # Reproject both masks to same CRS
-    # studyarea_utm = studyarea.to_crs(CRS)
-    # pop_centers_utm = pop_centers.to_crs(CRS)
-    # Make one giant geometry for each
-    # study_union = studyarea_utm.unary_union
-    # pop_union = pop_centers_utm.unary_union
-    # # Subtract population centers from study area
-    # mask_geom = study_union.difference(pop_union)
-    # # Wrap in GeoSeries so we can use it as mask
-    # combined_mask = gpd.GeoSeries([mask_geom], crs=studyarea_utm.crs)
-    # combined_mask.to_file(os.path.join(save_path, 'giant_mask.shp'))  # For DEBUG
-    # # Clip parcels: keep inside studyarea but outside pop_centers
-    # parcels_in_cbg_gdf = gpd.clip(parcel_gdf, combined_mask)
-    # # suggestion: first make a convex hull of the mask and include parcels inside that before performing the 'clip' func
-
-    print('removing parcels that are inside pop centers ---- NOT DONE. current method is too long')
-    # pop_centers_utm = pop_centers.to_crs(CRS)
-    # pop_union = pop_centers_utm.unary_union
-    # parcels_in_cbg_gdf["geometry"] = parcels_in_cbg_gdf.geometry.apply(lambda g: g.difference(pop_union))
-    # parcels_in_cbg_gdf = parcels_in_cbg_gdf[~parcels_in_cbg_gdf.geometry.is_empty]
-    _save_geopackage(parcels_in_cbg_gdf, save_path, 'parcels_out_pc.gpkg', driver='GPKG')
+    return parcel_gdf[mask]
+
+
+def preprocess_parcels(parcels_path, studyarea, pop_centers, save_path, writer=None, incremental=False,
+                       distance_bands_mi=None, CBG_gdf=None):
+    """
+    :param parcels_path: parcel layer, or residential parcels already loaded with read_residential_parcels
+    :param pop_centers: PopulationCenterIndex of the study area (a geo dataframe also works)
+    :param incremental: if True, compare the parcel layer with the previous run saved in save_path (by
+        county and parcel id, see _parcel_key_fields, and a hash of attributes + geometry) and only reprocess parcels
+        that were added or changed. Removed parcels are dropped from the previous outputs. Falls back to a full run if
+        there is no previous run, the study area or population centers changed, or parcel keys are not unique.
+    :param distance_bands_mi: edges of the distance bands to population centers (see add_distance_bands)
+    :param CBG_gdf: study CBGs. If given, their population and housing units are allocated to the parcels (see
+        allocate_to_parcels)
+    """
+    if writer is None:
+        with OutputWriter() as writer:
+            return preprocess_parcels(parcels_path, studyarea, pop_centers, save_path, writer=writer,
+                                      incremental=incremental, distance_bands_mi=distance_bands_mi,
+                                      CBG_gdf=CBG_gdf)
+    if not isinstance(pop_centers, PopulationCenterIndex):
+        check_crs(pop_centers, CRS, 'preprocess_parcels')
+        pop_centers = PopulationCenterIndex(pop_centers)
+
+    print('\n---- Preparing residential parcels inside studyarea and validating their geometries')
+    check_crs(studyarea, CRS, 'preprocess_parcels')
+    if isinstance(parcels_path, gpd.GeoDataFrame):
+        check_crs(parcels_path, CRS, 'preprocess_parcels')
+        # resident (e.g. statewide) parcels: its spatial index is built once and reused by every call
+        hits = parcels_path.sindex.query(studyarea.geometry, predicate='intersects')[1]
+        parcel_gdf = parcels_path.iloc[np.unique(hits)]
+    else:
+        parcel_gdf = read_residential_parcels(parcels_path, mask=studyarea)
+    # number of parcels (units) stacked on each footprint, for housing-weighted metrics. It is part of the row hash,
+    # so in incremental mode a change in a stack reprocesses every parcel of the stack
+    footprint_id = _footprint_ids(parcel_gdf)
+    parcel_gdf = parcel_gdf.assign(units_per_footprint=np.bincount(footprint_id)[footprint_id])
+
+    key_fields = _parcel_key_fields(parcel_gdf)
+    keys = _parcel_keys(parcel_gdf, key_fields) if key_fields else None
+    # a previous run keyed on other columns can't be compared with this one
+    context = f'{_parcel_run_context(studyarea, pop_centers)}_{"+".join(key_fields or [])}'
+    hashes = None
+    if keys is not None and keys.is_unique:
+        hashes = pd.Series(_hash_rows(parcel_gdf).values, index=keys)
+    elif incremental:
+        print(f'---- \t no unique parcel key ({" or ".join(parcel_id_fields)}, with {parcel_county_field} if '
+              f'present), incremental mode is disabled')
+
+    previous = _load_parcel_state(save_path, context) if (incremental and hashes is not None) else None
+    if previous is None:
+        parcels_in_cbg_gdf, parcels_out_pc_gdf = _prepare_parcel_geometries(parcel_gdf, studyarea, pop_centers,
+                                                                            footprint_id=footprint_id)
+    else:
+        prev_hashes, prev_in_cbg, prev_out_pc = previous
+        to_process, removed = _diff_parcels(hashes, prev_hashes)
+        print(f'---- \t incremental run: {len(to_process)} added/changed and {len(removed)} removed parcels '
+              f'out of {len(hashes)}')
+        process = keys.isin(to_process)
+        new_in_cbg, new_out_pc = _prepare_parcel_geometries(parcel_gdf[process], studyarea, pop_centers,
+                                                            footprint_id=footprint_id[process])
+        parcels_in_cbg_gdf = _replace_parcels(prev_in_cbg, new_in_cbg, to_process.append(removed), key_fields)
+        parcels_out_pc_gdf = _replace_parcels(prev_out_pc, new_out_pc, to_process.append(removed), key_fields)
+
+    # distances and allocations are cheap to recompute, so they are done for all parcels even in incremental mode
+    parcels_out_pc_gdf = add_distance_bands(parcels_out_pc_gdf, pop_centers, distance_bands_mi)
+    if CBG_gdf is not None:
+        # shares are computed over all residential parcels of a CBG, also those inside population centers
+        check_crs(CBG_gdf, CRS, 'preprocess_parcels')
+        parcels_in_cbg_gdf = allocate_to_parcels(parcels_in_cbg_gdf, CBG_gdf)
+        parcels_out_pc_gdf = _copy_allocation(parcels_in_cbg_gdf, parcels_out_pc_gdf,
+                                              key_fields if hashes is not None else None)
+    writer.submit(_save_parcel_run, parcels_in_cbg_gdf, parcels_out_pc_gdf, hashes, context, save_path)
+    return parcels_out_pc_gdf
 
 
 if __name__ == '__main__':
@@ -1,13 +1,24 @@
 import json
 import os.path
+import re
+import unicodedata
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 
-from .utils import _save_geopackage
+from .units import FEET_PER_METER
+from .utils import _hash_rows, _save_geopackage
 
 
 # Define the regex pattern for categories of interest
 filter_pattern = r'store|hospital|church|restaurant|salon|food|retailer|shop|post_office|gas_station|park|bar|barber|school|market'
+# buffer distances (feet) our planners look at for the accessibility sensitivity curve
+sweep_distances_ft = [150, 300, 500, 1000, 2640]
+# Overture extracts often have the same business several times, from different sources, a few meters apart. POIs
+# closer than this with the same normalized name and primary category are counted once (see deduplicate_POIs)
+duplicate_distance_m = 25
 
 def preprocess_POI_data(POI_path):
     ### WE NEED TO MAKE A SHAPEFILE FOR THE POI DATA From given geojson WA WE CAN USE IN ARC GIS PRO
@@ -39,59 +50,183 @@ def parse_categories(cat_str):
         return {'primary': None, 'alternate': []}
 
 
-def filter_SR_POI(POI_SR_path, save_path=None):
-    print('\n---- Processing SR-buffered POI data')
-    ### AFTER GETTING THE SHAPEFILE OF POI WITHIN 300 FT OF _ **SR**_ FROM ARCGIS PRO,
-    # WE NEED TO FILTER THEM OUT HERE TO KEEP ONLY THOSE THAT COULD BE CONSIDERED AS PRIMARY POI
-    if type(POI_SR_path) is tuple:
-        POI_Within_SR_Buffer_0 = gpd.read_file(POI_SR_path[0], layer=POI_SR_path[1])
-    else:
-        POI_Within_SR_Buffer_0 = gpd.read_file(POI_SR_path)
-    POI_Within_SR_Buffer_1 = POI_Within_SR_Buffer_0.copy()
-    POI_Within_SR_Buffer_1['categories_json'] = POI_Within_SR_Buffer_1['categories'].apply(parse_categories)
-    POI_Within_SR_Buffer_1['primary_category'] = POI_Within_SR_Buffer_1['categories_json'].apply(
-        lambda x: x.get('primary'))
-    POI_Within_SR_Buffer_1['alternate_categories'] = POI_Within_SR_Buffer_1['categories_json'].apply(
-        lambda x: x.get('alternate', []))
+def _parse_category_column(categories):
+    """
+    parses the 'categories' json strings. Each distinct string is parsed once (many POIs share the same categories).
+    :return: (categories_json, primary_category, alternate_categories) series
+    """
+    parsed = {c: parse_categories(c) for c in pd.unique(categories)}
+    categories_json = categories.map(parsed)
+    primary_category = categories_json.map(lambda x: x.get('primary'))
+    alternate_categories = categories_json.map(lambda x: x.get('alternate', []))
+    return categories_json, primary_category, alternate_categories
+
+
+def _normalize_name(names):
+    """primary name of an Overture 'names' value (json string or dict) in lower case ascii letters and digits"""
+    if isinstance(names, str):
+        try:
+            names = json.loads(names)
+        except json.JSONDecodeError:
+            pass  # a plain name
+    if isinstance(names, dict):
+        names = names.get('primary')
+    if not isinstance(names, str):
+        return None
+    # apostrophes are dropped, not turned into a space, so "Joe's Cafe" and "Joes Cafe" are the same name
+    names = re.sub(r"['\u2019]", '', names)
+    names = unicodedata.normalize('NFKD', names).encode('ascii', 'ignore').decode().lower()
+    return re.sub(r'[^a-z0-9]+', ' ', names).strip() or None
+
+
+def _connected_groups(n, i, j):
+    """
+    union-find over the pairs (i, j), done for all pairs at once: every element is hooked to the smallest element
+    it is connected to, and paths are compressed until the pairs agree
+    :return: np.ndarray, the group (smallest member) of each of the n elements
+    """
+    parent = np.arange(n)
+    while True:
+        root_i, root_j = parent[i], parent[j]
+        apart = root_i != root_j
+        if not apart.any():
+            return parent
+        np.minimum.at(parent, np.maximum(root_i, root_j)[apart], np.minimum(root_i, root_j)[apart])
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+
+def deduplicate_POIs(POI_gdf, distance_m=duplicate_distance_m, crs=32610, name_column='names',
+                     category_column='primary_category'):
+    """
+    merges near-duplicate POIs: POIs with the same normalized name and category that are within distance_m of each
+    other (directly or through a chain of such POIs) are one place, and only the record with the highest
+    'confidence' is kept. Without the name or category column nothing is merged.
+
+    POIs are put in a grid of distance_m cells, so each POI is only compared with the POIs of its own and the
+    neighboring cells that have the same name and category (each pair of neighboring cells is joined once). That
+    keeps the work close to linear in the number of POIs. If the frame has a 'road_type' column (see
+    merge_SR_and_CR_POIs), a place found along both road types becomes 'both'.
+
+    :return: (deduplicated POIs with a 'merged_POIs' column counting the dropped copies, number of dropped copies
+        per category)
+    """
+    if len(POI_gdf) == 0 or name_column not in POI_gdf.columns or category_column not in POI_gdf.columns:
+        return POI_gdf.assign(merged_POIs=0), pd.Series(dtype=int)
+    points = POI_gdf.geometry.to_crs(crs).representative_point()
+    try:
+        # each distinct name is normalized once
+        codes, distinct = pd.factorize(POI_gdf[name_column])
+        names = pd.Series(np.array([_normalize_name(n) for n in distinct] + [None], dtype=object)[codes],
+                          index=POI_gdf.index)
+    except TypeError:  # names read as dicts can't be factorized
+        names = POI_gdf[name_column].map(_normalize_name)
+    key = pd.factorize(names.fillna('') + '|' + POI_gdf[category_column].fillna('').astype(str))[0]
+    key[names.isna().values] = -1  # POIs without a name are never duplicates
+    cells = pd.DataFrame({'key': key, 'cx': np.floor(points.x.values / distance_m).astype(np.int64),
+                          'cy': np.floor(points.y.values / distance_m).astype(np.int64),
+                          'pos': np.arange(len(POI_gdf))})
+    cells = cells[cells['key'] >= 0]
+
+    pairs = []
+    for dx, dy in [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]:
+        shifted = cells.assign(cx=cells['cx'] + dx, cy=cells['cy'] + dy)
+        pair = shifted.merge(cells, on=['key', 'cx', 'cy'], suffixes=('_i', '_j'))
+        if dx == dy == 0:
+            pair = pair[pair['pos_i'] < pair['pos_j']]
+        pairs.append(pair[['pos_i', 'pos_j']].to_numpy())
+    i, j = np.concatenate(pairs).T
+    close = shapely.distance(points.values[i], points.values[j]) <= distance_m
+    group = _connected_groups(len(POI_gdf), i[close], j[close])
+
+    # the record with the highest confidence of each group (the first one if there is no confidence or a tie)
+    confidence = (POI_gdf['confidence'].fillna(-np.inf).to_numpy(dtype=float) if 'confidence' in POI_gdf.columns
+                  else np.zeros(len(POI_gdf)))
+    order = np.lexsort((np.arange(len(POI_gdf)), -confidence, group))
+    keep = np.sort(order[np.r_[True, group[order][1:] != group[order][:-1]]])
+
+    size = np.bincount(group, minlength=len(POI_gdf))
+    deduplicated = POI_gdf.iloc[keep].assign(merged_POIs=size[group[keep]] - 1)
+    if 'road_type' in POI_gdf.columns:
+        mixed = pd.Series(POI_gdf['road_type'].values).groupby(group).nunique() > 1
+        deduplicated['road_type'] = np.where(mixed.reindex(group[keep]).values, 'both', deduplicated['road_type'])
+    dropped = np.ones(len(POI_gdf), dtype=bool)
+    dropped[keep] = False
+    merged_per_category = POI_gdf.loc[dropped, category_column].value_counts()
+    print(f'---- \t merged {dropped.sum()} duplicate POIs within {distance_m} m, {len(deduplicated)} POIs left')
+    return deduplicated, merged_per_category
+
+
+def _read_POIs(POI_path):
+    if type(POI_path) is tuple:
+        return gpd.read_file(POI_path[0], layer=POI_path[1])
+    return gpd.read_file(POI_path)
+
+
+def filter_POI_frame(POI_gdf, excel_path=None):
+    """
+    keeps the POIs whose primary category matches filter_pattern. Categories are parsed once; list and dict columns
+    are flattened to strings so the result can be written to any format.
+    :param excel_path: if given, all POIs with their parsed categories are written there for exploration
+    :return: filtered POIs
+    """
+    POI_gdf = POI_gdf.copy()
+    POI_gdf['categories_json'], POI_gdf['primary_category'], POI_gdf['alternate_categories'] = (
+        _parse_category_column(POI_gdf['categories']))
 
     # If you want to explore the data using Excel, check the following.
-    if save_path:
-        poi_export = POI_Within_SR_Buffer_1.drop(columns='geometry')
+    if excel_path:
+        poi_export = POI_gdf.drop(columns='geometry')
         # Convert the list of alternate categories to a comma-separated string
         poi_export['alternate_categories'] = poi_export['alternate_categories'].apply(
             lambda x: ', '.join(map(str, x)) if isinstance(x, list) else x)
-        excel_path = os.path.join(save_path, "POI_Within_SR_Buffer_1.xlsx")
         poi_export.to_excel(excel_path, index=False)
         print(f"Saved intermediate data for exploration to Excel at:\n{excel_path}")
 
-    unique_categories = POI_Within_SR_Buffer_1['primary_category'].unique()
+    unique_categories = POI_gdf['primary_category'].unique()
     print(f"\nFound {len(unique_categories)} unique primary categories. 10 examples:{unique_categories[:10]}")
     # Overture is organized around approximately 22 top-level categories. We need to use the primary categories
     # to filter the data. There are 349 unique primary categories in our shapefile for 1616 POI
 
     print('Filter POIs Based on Primary Category')
     # Use .str.contains() to filter the GeoDataFrame
-    POI_Within_SR_Buffer_2 = POI_Within_SR_Buffer_1[
-        POI_Within_SR_Buffer_1['primary_category'].str.contains(
+    filtered = POI_gdf[
+        POI_gdf['primary_category'].str.contains(
             filter_pattern,
             case=False,  # ignore_case = TRUE
             na=False,  # Don't match on NaN values
             regex=True
         )
     ].copy()
-    print(f"Filtered down to {len(POI_Within_SR_Buffer_2)} relevant POIs.")
+    print(f"Filtered down to {len(filtered)} relevant POIs.")
+    filtered, merged_per_category = deduplicate_POIs(filtered)
+    if len(merged_per_category):
+        print(f"Duplicates merged per category:\n{merged_per_category.to_string()}")
 
     # Cleanup for Shapefile Export ---- Probably not needed at all
     # Shapefiles do not support list or dictionary columns, so we flatten them.
-    POI_Within_SR_Buffer_3 = POI_Within_SR_Buffer_2.copy()
     # Flatten the 'categories_json' dictionary into a string
-    POI_Within_SR_Buffer_3['categories_json'] = POI_Within_SR_Buffer_3['categories_json'].apply(
+    filtered['categories_json'] = filtered['categories_json'].apply(
         lambda x: json.dumps(x)  # Re-serialize the dictionary to a clean JSON string
     )
     # Flatten the 'alternate_categories' list into a string
-    POI_Within_SR_Buffer_3['alternate_categories'] = POI_Within_SR_Buffer_3['alternate_categories'].apply(
+    filtered['alternate_categories'] = filtered['alternate_categories'].apply(
         lambda x: ', '.join(map(str, x)) if isinstance(x, list) else ''
     )
+    return filtered
+
+
+def filter_SR_POI(POI_SR_path, save_path=None):
+    print('\n---- Processing SR-buffered POI data')
+    ### AFTER GETTING THE SHAPEFILE OF POI WITHIN 300 FT OF _ **SR**_ FROM ARCGIS PRO,
+    # WE NEED TO FILTER THEM OUT HERE TO KEEP ONLY THOSE THAT COULD BE CONSIDERED AS PRIMARY POI
+    POI_Within_SR_Buffer_0 = _read_POIs(POI_SR_path)
+    POI_Within_SR_Buffer_3 = filter_POI_frame(
+        POI_Within_SR_Buffer_0,
+        excel_path=os.path.join(save_path, "POI_Within_SR_Buffer_1.xlsx") if save_path else None)
 
     print(f"Final data head before writing to shapefile has {len(POI_Within_SR_Buffer_3)} features.")
     file_name = 'POI_Within_SR_Buffer_Filtered.gpkg'
@@ -100,19 +235,124 @@ def filter_SR_POI(POI_SR_path, save_path=None):
     return POI_Within_SR_Buffer_3, file_name
 
 
+def poi_road_distance_sweep(POI_gdf, roads_gdf, distances_ft=None, crs=32610, save_path=None):
+    """
+    POI accessibility for several road buffer distances in one pass. Instead of buffering the roads and clipping the
+    POIs once per distance, the distance from every POI to its nearest road is computed once (bulk nearest query on
+    a spatial index) and each POI is assigned to the smallest threshold it satisfies. Cumulative sums over the
+    thresholds then give the results for every buffer distance. Near-duplicate POIs are merged first (see
+    deduplicate_POIs).
+
+    :param POI_gdf: POIs (Overture format, with a 'categories' json column)
+    :param roads_gdf: rural roads (Step 4 output). If it has a GEOID10 column, POIs are counted for the CBG of their
+        nearest road.
+    :param distances_ft: buffer distances in feet (default: sweep_distances_ft)
+    :return: dict of data frames: 'summary' (POI counts per distance), 'categories' (primary category counts per
+        distance) and, if available, 'CBGs' (POI counts per CBG and distance)
+    """
+    # each distance is a band, so a distance given twice ('300, 300') is one band
+    distances_ft = sorted(set(distances_ft or sweep_distances_ft))
+    print(f'\n---- POI accessibility sweep for road buffers of {distances_ft} ft')
+    POI_gdf = POI_gdf.to_crs(crs).assign(primary_category=_parse_category_column(POI_gdf['categories'])[1].values)
+    # near-duplicate records of the same place are counted once, like in filter_POI_frame
+    POI_gdf = deduplicate_POIs(POI_gdf, crs=crs)[0]
+    roads_gdf = roads_gdf[roads_gdf.geometry.notna() & ~roads_gdf.geometry.is_empty].to_crs(crs)
+
+    pois = np.asarray(POI_gdf.geometry.values, dtype=object)
+    tree = shapely.STRtree(np.asarray(roads_gdf.geometry.values, dtype=object))
+    # POIs farther than the largest distance don't matter, max_distance keeps the nearest search local
+    (poi_idx, road_idx), dist = tree.query_nearest(pois, max_distance=distances_ft[-1] / FEET_PER_METER,
+                                                   return_distance=True, all_matches=False)
+    dist_ft = np.full(len(pois), np.inf)
+    dist_ft[poi_idx] = dist * FEET_PER_METER
+    nearest_road = np.full(len(pois), -1)
+    nearest_road[poi_idx] = road_idx
+
+    # index of the smallest buffer distance that reaches each POI (len(distances_ft) if none does)
+    band = np.searchsorted(distances_ft, dist_ft, side='left')
+    reached = band < len(distances_ft)
+    band_labels = pd.Categorical.from_codes(band[reached], categories=distances_ft)
+
+    # astype(str): without POIs the column is an empty float column
+    primary_category = POI_gdf['primary_category'].fillna('unknown').astype(str).values
+    relevant = pd.Series(primary_category, dtype=str).str.contains(filter_pattern, case=False, regex=True).values
+
+    def _cumulative(keys, name, columns=None):
+        # counts per (band, key), accumulated so that each distance includes all the closer POIs. Every band is a
+        # row, and every key of `columns` is a column, even when no POI is reached
+        keys = pd.Categorical(np.asarray(keys, dtype=object), categories=columns)
+        table = pd.crosstab(band_labels, keys, dropna=False, colnames=[name]).reindex(distances_ft, fill_value=0)
+        table.index.name = 'buffer_ft'
+        return table.cumsum(axis=0).astype(int)
+
+    results = {}
+    totals = _cumulative(np.where(relevant[reached], 'relevant_POIs', 'other_POIs'), 'POIs',
+                         columns=['relevant_POIs', 'other_POIs'])
+    totals['all_POIs'] = totals.sum(axis=1)
+    results['summary'] = totals
+    # every category of the POIs and every CBG of the roads gets a row, also with no POI within reach
+    results['categories'] = _cumulative(primary_category[reached], 'primary_category',
+                                        columns=pd.unique(primary_category)).T.astype(int)
+    if 'GEOID10' in roads_gdf.columns:
+        geoids = roads_gdf['GEOID10'].values[nearest_road[reached]]
+        results['CBGs'] = _cumulative(geoids, 'GEOID10', columns=pd.unique(roads_gdf['GEOID10'].values)).T.astype(int)
+
+    print(results['summary'])
+    if save_path:
+        excel_path = os.path.join(save_path, 'POI_buffer_sweep.xlsx')
+        with pd.ExcelWriter(excel_path) as excel_writer:
+            for name, table in results.items():
+                table.to_excel(excel_writer, sheet_name=name)
+        print(f'---- \t saved {excel_path}')
+    return results
+
+
 # def filter_CR_POI(POI_CR_path, save_path=None):
 #     #todo
 #     return None, None
 
 
+def merge_SR_and_CR_POIs(SR_POI_gdf, CR_POI_gdf, id_column='id'):
+    """
+    POIs of both road buffers without duplicates, with a 'road_type' column: 'SR', 'CR' or 'both' (POIs within the
+    buffer of a state and a county road). POIs are matched by their Overture id, or by all their attributes and
+    geometry if there is no id column.
+    """
+    if CR_POI_gdf.crs != SR_POI_gdf.crs:
+        CR_POI_gdf = CR_POI_gdf.to_crs(SR_POI_gdf.crs)
+    if id_column in SR_POI_gdf.columns and id_column in CR_POI_gdf.columns:
+        sr_keys, cr_keys = SR_POI_gdf[id_column], CR_POI_gdf[id_column]
+    else:
+        # json fields can be read as dicts/lists, which can't be hashed, so everything is hashed as text
+        columns = [c for c in SR_POI_gdf.columns.intersection(CR_POI_gdf.columns) if c != SR_POI_gdf.geometry.name]
+        sr_keys = _hash_rows(SR_POI_gdf.astype({c: str for c in columns}), columns=columns)
+        cr_keys = _hash_rows(CR_POI_gdf.astype({c: str for c in columns}), columns=columns)
+    sr_unique = ~sr_keys.duplicated().values
+    cr_only = ~cr_keys.isin(sr_keys).values & ~cr_keys.duplicated().values
+    in_cr = sr_keys.isin(cr_keys).values
+    merged = pd.concat([SR_POI_gdf[sr_unique].assign(road_type=np.where(in_cr[sr_unique], 'both', 'SR')),
+                        CR_POI_gdf[cr_only].assign(road_type='CR')], ignore_index=True)
+    print(f"---- \t {len(merged)} unique POIs: {merged['road_type'].value_counts().to_dict()}")
+    return merged
+
+
 def filter_SR_and_CR_POIs(POI_SR_path, POI_CR_path, save_path):
+    """
+    filters the POIs within the state road (SR) and county road (CR) buffers in one pass: both inputs are read,
+    merged without duplicates (see merge_SR_and_CR_POIs), and filtered once.
+    :return: (filtered POIs with 'road_type', file name of the output geopackage in save_path)
+    """
     # in the original R file there was two different ways to filter SR and CR POIs. The only difference was a corrupted
     # entry for CR POIs but when running on python I didn't run into the same error Panick got so it seemed that the
-    # function I wrote for SR POIs
-    filtered_sr_POIs, filtered_sr_POIs_filename = filter_SR_POI(POI_SR_path, save_path)
-    # filtered_cr_POIs, filtered_sr_POIs_filename = filter_CR_POI(POI_CR_path, save_path)
-    filtered_cr_POIs, filtered_sr_POIs_filename = filter_SR_POI(POI_CR_path, save_path)
-    return filtered_sr_POIs, filtered_sr_POIs_filename, filtered_cr_POIs, filtered_sr_POIs_filename
+    # function I wrote for SR POIs works for both
+    print('\n---- Processing SR- and CR-buffered POI data')
+    POIs = merge_SR_and_CR_POIs(_read_POIs(POI_SR_path), _read_POIs(POI_CR_path))
+    filtered_POIs = filter_POI_frame(
+        POIs, excel_path=os.path.join(save_path, "POI_Within_SR_CR_Buffer_1.xlsx") if save_path else None)
+    file_name = 'POI_Within_SR_CR_Buffer_Filtered.gpkg'
+    _save_geopackage(filtered_POIs, save_path, file_name, driver="GPKG")
+    print(f"-----> Successfully wrote filtered poi data to: {file_name}")
+    return filtered_POIs, file_name
 
 
 def filter_POIs(gdb_path, POI_layer, save_path):
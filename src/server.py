@@ -0,0 +1,169 @@
+"""
+Optional long-lived worker that keeps the base layers (SLD, population centers, NCES locales, residential parcels)
+projected and indexed in memory between toolbox runs.
+
+Start it once for a state:
+
+    python -m src.cli serve assets/example.yml
+
+Then every run of the ArcGIS tool (or `python -m src.cli preprocess --server ...`) sends its counties and output
+folder to the worker over a local socket, and only the county-specific preprocessing runs. If no worker is
+listening, the tool falls back to the normal in-process preprocessing.
+
+Requests are pickled, so only clients that know the server's key may connect. Every server makes a random key and
+writes it to a file in the user's home folder that only the user can read (see _authkey_path); clients of the same
+user read it from there. The file is removed when the server stops.
+"""
+import os
+import time
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from .preprocess import load_base_layers, run_preprocess
+from .utils import _file_fingerprint
+
+
+default_address = ('localhost', 6543)
+
+
+def _authkey_path(address):
+    return os.path.join(os.path.expanduser('~'), f'.RuralATGapFinder_server_{address[1]}.key')
+
+
+def _new_authkey(address):
+    """random key for a new server, saved in a file only the current user can read"""
+    key = os.urandom(32).hex().encode()
+    path = _authkey_path(address)
+    if os.path.exists(path):
+        os.remove(path)  # left by a server that didn't stop cleanly. Recreated below so the permissions are ours
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+        f.write(key)
+    return key
+
+
+def _read_authkey(address):
+    try:
+        with open(_authkey_path(address), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def serve(state_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, address=default_address, authkey=None,
+          water_path=None):
+    """
+    loads the base layers of the state and answers requests until it receives a 'shutdown' request
+    :param authkey: key clients must know. By default a random one is made and shared through _authkey_path
+    """
+    print(f'\n---- analysis server: loading base layers for {state_in}')
+    # taken before loading, so a file that changes while the server runs is reported as different by `ping`
+    inputs = input_fingerprints(sld_gdb_path, pop_ctr_path, nces_path, parcel_path, water_path)
+    base = load_base_layers(state_in, sld_gdb_path, pop_ctr_path, nces_path, parcel_path, water_path=water_path)
+    for name in base:
+        base[name]  # wait for every layer, so loading errors show up before the server starts listening
+    # build the spatial indexes now so the first request doesn't pay for them
+    base['parcels'].sindex
+    base['area_type'].sindex
+
+    key_file = None
+    if authkey is None:
+        authkey, key_file = _new_authkey(address), _authkey_path(address)
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print(f'---- analysis server: listening on {address[0]}:{address[1]}')
+            while True:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    print('---- analysis server: rejected a client with a wrong key')
+                    continue
+                except (EOFError, OSError) as e:
+                    # a client that goes away must not stop the server
+                    print(f'---- analysis server: a client disconnected during the handshake ({e!r})')
+                    continue
+                with conn:
+                    try:
+                        request = conn.recv()
+                        if request.get('command') == 'shutdown':
+                            conn.send({'status': 'ok'})
+                            break
+                        conn.send(_handle(base, request, inputs))
+                    except (EOFError, OSError) as e:
+                        print(f'---- analysis server: lost the connection to a client ({e!r})')
+    finally:
+        if key_file and os.path.exists(key_file):
+            os.remove(key_file)
+    print('---- analysis server: stopped')
+
+
+def input_fingerprints(sld_gdb_path, pop_ctr_path, nces_path, parcel_path, water_path=None):
+    """{input name: (absolute path, _file_fingerprint)} of the base layer inputs, to check that a server was loaded
+    from the same files (same path, size and modification time) as the caller's"""
+    paths = {'sld': sld_gdb_path, 'population_centers': pop_ctr_path, 'nces': nces_path, 'parcels': parcel_path,
+             'water': water_path}
+    return {name: (os.path.abspath(path), _file_fingerprint(path)) if path else None for name, path in paths.items()}
+
+
+def _handle(base, request, inputs=None):
+    command = request.get('command')
+    start = time.perf_counter()
+    try:
+        if command == 'ping':
+            return {'status': 'ok', 'state_name': base['state_name'], 'inputs': inputs}
+        elif command == 'preprocess':
+            run_preprocess(base, request['counties'], save_path=request.get('save_path'),
+                           incremental=request.get('incremental', False),
+                           distance_bands_mi=request.get('distance_bands_mi'))
+        else:
+            raise ValueError(f'unknown command {command!r}')
+    except Exception as e:
+        return {'status': 'error', 'error': repr(e), 'traceback': traceback.format_exc()}
+    return {'status': 'ok', 'state_name': base['state_name'], 'seconds': time.perf_counter() - start}
+
+
+def _send(request, address=default_address, authkey=None):
+    authkey = authkey or _read_authkey(address)
+    if authkey is None:
+        raise ConnectionRefusedError(f'no analysis server key at {_authkey_path(address)}')
+    with Client(address, authkey=authkey) as conn:
+        conn.send(request)
+        reply = conn.recv()
+    if reply['status'] == 'error':
+        raise RuntimeError(f"analysis server failed: {reply['error']}\n{reply['traceback']}")
+    return reply
+
+
+def server_available(state_in=None, inputs=None, address=default_address, authkey=None):
+    """
+    True if a worker is listening and, when given, holds the layers of state_in loaded from the same input files
+    :param inputs: input_fingerprints(...) of the caller's inputs. Any difference in paths or file contents (size,
+        modification time) means the caller has to read its own inputs
+    """
+    try:
+        reply = _send({'command': 'ping'}, address=address, authkey=authkey)
+    except (ConnectionError, OSError, EOFError, AuthenticationError):
+        return False
+    if state_in is not None and reply['state_name'] != state_in:
+        print(f"---- analysis server holds {reply['state_name']}, not {state_in}")
+        return False
+    if inputs is not None:
+        different = [name for name in inputs if (reply.get('inputs') or {}).get(name) != inputs[name]]
+        if different:
+            print(f'---- analysis server was loaded from other inputs ({", ".join(different)}), reading them here')
+            return False
+    return True
+
+
+def request_preprocess(counties, save_path, incremental=False, distance_bands_mi=None, address=default_address,
+                       authkey=None):
+    """runs run_preprocess on the worker. Errors raised on the worker are raised here as RuntimeError."""
+    reply = _send({'command': 'preprocess', 'counties': list(counties), 'save_path': save_path,
+                   'incremental': incremental, 'distance_bands_mi': distance_bands_mi},
+                  address=address, authkey=authkey)
+    print(f"---- preprocessing done by the analysis server in {reply['seconds']:.1f} s")
+    return reply
+
+
+def shutdown(address=default_address, authkey=None):
+    return _send({'command': 'shutdown'}, address=address, authkey=authkey)
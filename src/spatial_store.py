@@ -0,0 +1,115 @@
+"""
+Spatially partitioned on-disk copies of the big input layers (parcels, POIs, SLD CBGs, NCES locales, roads).
+
+A store is a folder of GeoParquet files plus a manifest.json. Features are sorted along a Hilbert curve before they
+are cut into partitions, so each partition covers a compact area, and the manifest keeps the bounding box of every
+partition. Reading a store with a mask (e.g. the study area) only opens the partitions whose box overlaps the mask,
+so a single-county run reads a few partitions instead of the whole state.
+
+    write_partitioned(gpd.read_file('Parcels_2024.shp'), 'stores/parcels')
+    parcels = read_layer('stores/parcels', mask=studyarea)
+
+`read_layer` also accepts ordinary files, so any input path of the pipeline can point to either.
+"""
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS as pyCRS
+
+from .utils import _mask_geometry
+
+
+manifest_filename = 'manifest.json'
+
+
+def is_partitioned_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, manifest_filename))
+
+
+def write_partitioned(gdf, store_dir, rows_per_partition=50000):
+    """
+    sorts the features along a Hilbert curve and writes them as GeoParquet partitions of `rows_per_partition` rows
+    :return: the manifest (also saved as store_dir/manifest.json)
+    """
+    print(f'\n---- writing {len(gdf)} features to partitioned store {store_dir}')
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    order = np.argsort(gdf.geometry.hilbert_distance(total_bounds=gdf.total_bounds).values, kind='stable')
+    gdf = gdf.iloc[order]
+
+    os.makedirs(store_dir, exist_ok=True)
+    partitions = []
+    for i, start in enumerate(range(0, len(gdf), rows_per_partition)):
+        part = gdf.iloc[start:start + rows_per_partition]
+        filename = f'part_{i:05d}.parquet'
+        # the index is saved with the rows, so a read gets the same labels (e.g. feature ids) back
+        part.to_parquet(os.path.join(store_dir, filename), index=True)
+        partitions.append({'file': filename, 'rows': len(part), 'bbox': [float(b) for b in part.total_bounds]})
+
+    manifest = {'crs': gdf.crs.to_json() if gdf.crs else None, 'columns': list(gdf.columns),
+                'partitions': partitions}
+    with open(os.path.join(store_dir, manifest_filename), 'w') as f:
+        json.dump(manifest, f)
+    print(f'---- \t wrote {len(partitions)} partitions')
+    return manifest
+
+
+def _read_manifest(store_dir):
+    with open(os.path.join(store_dir, manifest_filename)) as f:
+        return json.load(f)
+
+
+def read_partitioned(store_dir, mask=None, columns=None):
+    """
+    reads a partitioned store. With a mask, only partitions whose bounding box intersects the mask are read, and
+    only rows whose bounding box intersects the mask's bounding box are returned. Exact clipping is left to the
+    caller, like with gpd.read_file(..., mask=...). Rows keep the index they had when the store was written.
+    """
+    manifest = _read_manifest(store_dir)
+    crs = pyCRS.from_json(manifest['crs']) if manifest['crs'] else None
+    partitions = manifest['partitions']
+    if columns is not None and 'geometry' not in columns:
+        columns = list(columns) + ['geometry']
+
+    if mask is not None:
+        mask = _mask_geometry(mask, crs)
+        boxes = shapely.box(*np.array([p['bbox'] for p in partitions]).T) if partitions else np.array([])
+        partitions = [p for p, hit in zip(partitions, shapely.intersects(mask, boxes)) if hit]
+        print(f'---- \t reading {len(partitions)} of {len(manifest["partitions"])} partitions of {store_dir}')
+
+    if not partitions:
+        first = manifest['partitions'][0]['file'] if manifest['partitions'] else None
+        if first is None:
+            return gpd.GeoDataFrame(columns=manifest['columns'], geometry='geometry', crs=crs)
+        return gpd.read_parquet(os.path.join(store_dir, first), columns=columns).iloc[:0]
+
+    gdf = pd.concat([gpd.read_parquet(os.path.join(store_dir, p['file']), columns=columns) for p in partitions])
+    if mask is not None:
+        minx, miny, maxx, maxy = mask.bounds
+        b = gdf.geometry.bounds
+        gdf = gdf[(b.maxx >= minx) & (b.minx <= maxx) & (b.maxy >= miny) & (b.miny <= maxy)]
+    return gdf
+
+
+def read_layer(path, layer=None, mask=None):
+    """
+    reads either a partitioned store (with partition pruning when a mask is given) or any file gpd.read_file
+    understands. For plain files the mask is ignored so the results stay the same as a whole-file read.
+    """
+    if is_partitioned_store(path):
+        return read_partitioned(path, mask=mask)
+    return gpd.read_file(path, layer=layer)
+
+
+def partition_layer(src_path, store_dir, layer=None, crs=None, rows_per_partition=50000):
+    """
+    converts a layer from disk into a partitioned store, optionally reprojecting it first. The feature ids are kept
+    as the index, like ingest.read_projected does for plain files.
+    """
+    gdf = gpd.read_file(src_path, layer=layer, fid_as_index=True)
+    if crs is not None:
+        gdf = gdf.to_crs(crs)
+    return write_partitioned(gdf, store_dir, rows_per_partition=rows_per_partition)
@@ -0,0 +1,287 @@
+"""
+Light-weight versions of the result layers for display.
+
+    - export_display_layers: a few simplified copies of each layer (one per zoom level in display_zooms) in
+      display_layers.gpkg, with the map scale range each copy is meant for. The toolbox adds them to the ArcGIS map
+      with those scale ranges instead of the full resolution layers, which keeps the map fast at county/state extent.
+    - export_mbtiles: an MBTiles vector tile archive of the result layers (Mapbox Vector Tiles, EPSG:3857) that can be
+      opened without ArcGIS, e.g. in QGIS or served to a web map. Tiles are encoded in parallel in worker processes.
+      Needs the optional `mapbox_vector_tile` package. Run it from the command line (python -m src.cli tiles ...),
+      not from inside ArcGIS Pro, since it starts new python processes.
+
+Polygon layers that share boundaries (the two CBG layers, which are complementary parts of one CBG coverage) are
+simplified together as one coverage with shapely.coverage_simplify, so neighbors still share the exact same
+simplified edge, also across the two layers, and no gaps or overlaps show up between them. Other layers use simplify
+with preserve_topology=True.
+"""
+import gzip
+import json
+import math
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from .utils import _to_multipolygons
+
+web_mercator = 3857
+tile_extent = 4096  # MVT grid size of one tile
+tile_buffer = 64  # features are clipped this many grid units outside the tile, so strokes don't end at tile edges
+earth_circumference = 2 * math.pi * 6378137
+display_zooms = (8, 11, 14)
+display_filename = 'display_layers.gpkg'
+mbtiles_filename = 'results.mbtiles'
+# output files of the pipeline that go into the tile archive: layer name -> (file name, shares boundaries)
+result_layers = {
+    'population_centers': ('POPULATION_CENTERS_STUDY_AREA.gpkg', False),
+    'cbgs_right_outside_pcs': ('CBGs_RIGHT_OUTSIDE_PCs.gpkg', True),
+    'cbgs_not_intersect_pcs': ('CBGs_NOT_INTERSECT_PCs.gpkg', True),
+    'rural_roads': ('rural_roads_bike_coverage.gpkg', False),
+    'residential_parcels': ('parcels_out_pc.gpkg', False),
+    'pois': ('POI_Within_SR_Buffer_Filtered.gpkg', False),
+}
+
+
+def zoom_resolution(zoom):
+    """meters per pixel of a 256 pixel web map tile at this zoom (at the equator)"""
+    return earth_circumference / (256 * 2 ** zoom)
+
+
+def zoom_scale(zoom):
+    """map scale denominator at this zoom, with the 0.28 mm pixel that ArcGIS and OGC use"""
+    return zoom_resolution(zoom) / 0.00028
+
+
+def _with_geometries(gdf, geoms):
+    simplified = gdf.copy()
+    simplified[gdf.geometry.name] = gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs)
+    return simplified[simplified.geometry.notna() & ~simplified.geometry.is_empty]
+
+
+def simplify_layer(gdf, tolerance, coverage=False):
+    """simplified copy of the layer, empty results are dropped"""
+    if coverage:
+        return simplify_layers({'layer': gdf}, tolerance, coverage_layers=['layer'])['layer']
+    geoms = shapely.simplify(np.asarray(gdf.geometry.values, dtype=object), tolerance, preserve_topology=True)
+    return _with_geometries(gdf, geoms)
+
+
+def simplify_layers(layers, tolerance, coverage_layers=()):
+    """
+    simplified copies of the layers. The coverage_layers are simplified together as one coverage and split back, so
+    the boundaries they share stay shared, also between two of them. Point layers are returned as they are.
+    """
+    simplified = {}
+    # reprojecting can leave collapsed parts (lines, collections) that coverage_simplify doesn't accept
+    coverage = {name: _to_multipolygons(gdf, make_valid=True) for name, gdf in layers.items()
+                if name in coverage_layers}
+    if coverage:
+        geoms = np.concatenate([np.asarray(gdf.geometry.values, dtype=object) for gdf in coverage.values()])
+        geoms = shapely.coverage_simplify(geoms, tolerance)
+        start = 0
+        for name, gdf in coverage.items():
+            simplified[name] = _with_geometries(gdf, geoms[start:start + len(gdf)])
+            start += len(gdf)
+    for name, gdf in layers.items():
+        if name not in simplified:
+            simplified[name] = gdf if _is_points(gdf) else simplify_layer(gdf, tolerance)
+    return {name: simplified[name] for name in layers}
+
+
+def _is_points(gdf):
+    return gdf.geom_type.isin(['Point', 'MultiPoint']).all()
+
+
+def export_display_layers(layers, save_path, zooms=display_zooms, coverage_layers=()):
+    """
+    writes one simplified copy of every layer per zoom in `zooms` to save_path/display_layers.gpkg. The copy for
+    zoom z is simplified with the pixel size of z and is meant for map scales between the previous zoom and z.
+    Point layers are written once, as they are.
+    :param layers: {layer name: geo dataframe}
+    :param coverage_layers: names of polygon layers that share boundaries (see simplify_layers)
+    :return: {layer name: [(gpkg layer name, min scale, max scale)]}. min scale is the most zoomed-out scale the
+        copy is for (0 = no limit) and max scale the most zoomed-in one (0 = no limit), like the minThreshold and
+        maxThreshold of an ArcGIS layer. The last zoom is followed by the full resolution layer, which is not written.
+    """
+    print(f'\n---- Writing simplified display layers for zooms {list(zooms)}')
+    path = os.path.join(save_path, display_filename)
+    display = {name: [] for name in layers}
+    shapes = {}
+    for name, gdf in layers.items():
+        gdf = gdf.to_crs(web_mercator)
+        if _is_points(gdf):
+            gdf.to_file(path, layer=name, driver='GPKG')
+            display[name] = [(name, 0, 0)]
+        else:
+            shapes[name] = gdf
+    for i, zoom in enumerate(zooms):
+        for name, simplified in simplify_layers(shapes, zoom_resolution(zoom), coverage_layers).items():
+            layer = f'{name}_z{zoom}'
+            simplified.to_file(path, layer=layer, driver='GPKG')
+            display[name].append((layer, zoom_scale(zooms[i - 1]) if i else 0, zoom_scale(zoom)))
+    print(f'---- \t saved {path}')
+    return display
+
+
+# -------------------------------------------------------------- vector tiles
+def _tile_bounds(z, x, y):
+    """web mercator bounds of tile (z, x, y), y counted from the top like in XYZ tile URLs"""
+    size = earth_circumference / 2 ** z
+    minx = -earth_circumference / 2 + x * size
+    maxy = earth_circumference / 2 - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def _tiles_with_data(geoms, zoom):
+    """(x, y) of every tile at this zoom that one of the geometries touches"""
+    minx, miny, maxx, maxy = shapely.total_bounds(geoms)
+    size = earth_circumference / 2 ** zoom
+    half = earth_circumference / 2
+    last = 2 ** zoom - 1
+    xs = np.arange(max(int((minx + half) // size), 0), min(int((maxx + half) // size), last) + 1)
+    ys = np.arange(max(int((half - maxy) // size), 0), min(int((half - miny) // size), last) + 1)
+    x, y = (a.ravel() for a in np.meshgrid(xs, ys))
+    boxes = shapely.box(*_tile_bounds(zoom, x, y))
+    hit = np.unique(shapely.STRtree(geoms).query(boxes, predicate='intersects')[0])
+    return x[hit], y[hit]
+
+
+def _properties(gdf):
+    """attribute records with only the value types MVT can store (missing values are left out)"""
+    attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    for column in attributes.columns:
+        if not (pd.api.types.is_numeric_dtype(attributes[column]) or pd.api.types.is_bool_dtype(attributes[column])):
+            attributes[column] = attributes[column].astype(str).where(attributes[column].notna())
+    return [{k: v for k, v in record.items() if pd.notna(v)} for record in attributes.to_dict('records')]
+
+
+_worker_layers = {}
+
+
+def _init_worker(layers):
+    """runs once in every worker process: keeps the layers of the current zoom and indexes them"""
+    global _worker_layers
+    _worker_layers = {name: (geoms, properties, shapely.STRtree(geoms)) for name, (geoms, properties) in
+                      layers.items()}
+
+
+def _encode_tiles(tiles):
+    import mapbox_vector_tile
+    encoded = []
+    for z, x, y in tiles:
+        bounds = _tile_bounds(z, x, y)
+        pad = (bounds[2] - bounds[0]) * tile_buffer / tile_extent
+        clip_box = (bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad)
+        tile_layers = []
+        for name, (geoms, properties, tree) in _worker_layers.items():
+            hits = np.sort(tree.query(shapely.box(*clip_box), predicate='intersects'))
+            clipped = shapely.clip_by_rect(geoms[hits], *clip_box)
+            features = [{'geometry': g, 'properties': properties[i]}
+                        for g, i in zip(clipped, hits) if not g.is_empty]
+            if features:
+                tile_layers.append({'name': name, 'features': features})
+        if tile_layers:
+            data = mapbox_vector_tile.encode(tile_layers, default_options={'quantize_bounds': bounds,
+                                                                           'extents': tile_extent})
+            encoded.append((z, x, y, gzip.compress(data)))
+    return encoded
+
+
+def _create_mbtiles(path):
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    return db
+
+
+def _mbtiles_metadata(layers, min_zoom, max_zoom):
+    lon_lat = pd.concat([gdf.geometry for gdf in layers.values()]).to_crs(4326)
+    minx, miny, maxx, maxy = lon_lat.total_bounds
+    fields = {name: {c: 'Number' if pd.api.types.is_numeric_dtype(gdf[c]) else 'String'
+                     for c in gdf.columns if c != gdf.geometry.name} for name, gdf in layers.items()}
+    return {
+        'name': 'RuralATGapFinder results',
+        'format': 'pbf',
+        'type': 'overlay',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'bounds': f'{minx},{miny},{maxx},{maxy}',
+        'center': f'{(minx + maxx) / 2},{(miny + maxy) / 2},{min_zoom}',
+        'json': json.dumps({'vector_layers': [{'id': name, 'fields': fields[name], 'minzoom': min_zoom,
+                                               'maxzoom': max_zoom} for name in layers]}),
+    }
+
+
+def export_mbtiles(layers, mbtiles_path, min_zoom=6, max_zoom=14, coverage_layers=(), max_workers=None,
+                   tiles_per_task=64):
+    """
+    builds an MBTiles archive of Mapbox Vector Tiles. For every zoom, the layers are simplified with the pixel size
+    of that zoom, and the tiles that have data are encoded in parallel by `max_workers` processes.
+    :param layers: {layer name: geo dataframe}
+    :param coverage_layers: names of polygon layers that share boundaries (see simplify_layers)
+    :return: number of tiles written
+    """
+    try:
+        import mapbox_vector_tile  # noqa: F401
+    except ImportError:
+        raise ImportError('export_mbtiles needs the mapbox_vector_tile package (pip install mapbox-vector-tile)')
+    print(f'\n---- Building vector tiles (zoom {min_zoom}-{max_zoom}) of {list(layers)}')
+    layers = {name: gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty].to_crs(web_mercator).reset_index(drop=True)
+              for name, gdf in layers.items()}
+    properties = {name: _properties(gdf) for name, gdf in layers.items()}
+
+    db = _create_mbtiles(mbtiles_path)
+    db.executemany('INSERT INTO metadata VALUES (?, ?)', _mbtiles_metadata(layers, min_zoom, max_zoom).items())
+    count = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        # half a tile pixel: simplification is not visible at this zoom
+        tolerance = earth_circumference / 2 ** zoom / tile_extent / 2
+        zoom_layers = {}
+        for name, gdf in simplify_layers(layers, tolerance, coverage_layers).items():
+            zoom_layers[name] = (np.asarray(gdf.geometry.values, dtype=object),
+                                 [properties[name][i] for i in gdf.index])
+        all_geoms = np.concatenate([geoms for geoms, _ in zoom_layers.values()])
+        if not len(all_geoms):
+            continue
+        x, y = _tiles_with_data(all_geoms, zoom)
+        tiles = [(zoom, int(i), int(j)) for i, j in zip(x, y)]
+        batches = [tiles[i:i + tiles_per_task] for i in range(0, len(tiles), tiles_per_task)]
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(zoom_layers,)) as pool:
+            for encoded in pool.map(_encode_tiles, batches):
+                # MBTiles counts tile rows from the bottom (TMS)
+                db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                               [(z, i, 2 ** z - 1 - j, data) for z, i, j, data in encoded])
+                count += len(encoded)
+        db.commit()
+        print(f'---- \t zoom {zoom}: {len(tiles)} tiles')
+    db.close()
+    print(f'---- \t saved {count} tiles to {mbtiles_path}')
+    return count
+
+
+def read_result_layers(save_path):
+    """the result layers of result_layers that exist in save_path, and the names of those that share boundaries"""
+    layers, coverage_layers = {}, []
+    for name, (filename, coverage) in result_layers.items():
+        path = os.path.join(save_path, filename)
+        if os.path.exists(path):
+            layers[name] = gpd.read_file(path)
+            if coverage:
+                coverage_layers.append(name)
+    return layers, coverage_layers
+
+
+def export_result_tiles(save_path, min_zoom=6, max_zoom=14, max_workers=None):
+    """display layers and the vector tile archive of the pipeline outputs saved in save_path"""
+    layers, coverage_layers = read_result_layers(save_path)
+    export_display_layers(layers, save_path, coverage_layers=coverage_layers)
+    return export_mbtiles(layers, os.path.join(save_path, mbtiles_filename), min_zoom=min_zoom, max_zoom=max_zoom,
+                          coverage_layers=coverage_layers, max_workers=max_workers)
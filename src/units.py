@@ -0,0 +1,6 @@
+"""
+Unit conversions shared by the preprocessing, POI and bike coverage steps. Kept in their own module, so using them
+doesn't import any of those steps.
+"""
+FEET_PER_METER = 3.28084
+METERS_PER_MILE = 1609.344
@@ -1,5 +1,14 @@
+import glob
+import hashlib
 import os
-from shapely.geometry import Polygon, MultiPolygon, GeometryCollection
+import threading
+from collections.abc import Mapping
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 
 
 def _save_geopackage(gdf, folder_path, filename, driver=None):
@@ -13,25 +22,291 @@ def _save_geopackage(gdf, folder_path, filename, driver=None):
     gdf.to_file(filepath, driver=driver)
     print(f'\n---- Saved {filepath}')
 
-def _geomcollection_to_multipolygon(geom):
-    if isinstance(geom, Polygon):
-        return MultiPolygon([geom])          # convert single Polygon to MultiPolygon
-    elif isinstance(geom, MultiPolygon):
-        return geom                          # already fine
-    elif isinstance(geom, GeometryCollection):
-        # extract only Polygon/MultiPolygon parts
-        polygons = [g for g in geom.geoms if isinstance(g, (Polygon, MultiPolygon))]
-        if polygons:
-            return MultiPolygon([p for poly in polygons for p in
-                                 (poly.geoms if isinstance(poly, MultiPolygon) else [poly])])
+
+def _save_excel(df, filepath, index=True):
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    df.to_excel(filepath, index=index)
+    print(f'\n---- Saved {filepath}')
+
+
+class OutputWriter(object):
+    """
+    Small pool of background threads that write finished frames to disk while the pipeline keeps computing.
+    GDAL releases the GIL while writing, so gpkg/shp writes really run in parallel with the next stage.
+
+    Frames handed to the writer must not be modified afterwards. `flush()` waits for every pending write and
+    re-raises the first error, so a failed write is never silently lost. Use it as a context manager to make sure
+    everything is on disk before the pipeline returns:
+
+        with OutputWriter() as writer:
+            writer.save_geopackage(gdf, save_dir, 'file.gpkg', driver='GPKG')
+            ...  # keep computing
+    """
+
+    def __init__(self, max_workers=2, max_pending=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='output_writer')
+        # bound the number of queued frames so we don't keep every output in memory at once
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._futures = []
+
+    def submit(self, func, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def save_geopackage(self, gdf, folder_path, filename, driver=None):
+        return self.submit(_save_geopackage, gdf, folder_path, filename, driver=driver)
+
+    def save_excel(self, df, filepath, index=True):
+        return self.submit(_save_excel, df, filepath, index=index)
+
+    def flush(self):
+        """Block until all pending writes are done. Raises the first exception raised by a write."""
+        futures, self._futures = self._futures, []
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future in done and future.exception() is not None:
+                wait(futures)  # let the other writes finish before giving control back
+                raise future.exception()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # the pipeline already failed, finish what was queued but don't hide the original error
+            self._executor.shutdown(wait=True)
+        return False
+
+
+def _copy_outcome(source, target):
+    try:
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+    except InvalidStateError:
+        pass  # the target was cancelled (TaskScheduler.cancel), the outcome is not needed anymore
+
+
+class TaskScheduler(Mapping):
+    """
+    Runs functions in a thread pool as soon as the tasks they depend on are done, e.g. the input layers of the
+    preprocessing: reads that don't depend on each other run at the same time (GDAL and pyproj release the GIL), and
+    a task that needs other results starts right when the last of them is ready.
+
+        tasks = TaskScheduler()
+        tasks.add('counties', get_state_counties, 'WA')
+        tasks.add('sld', read_layer, sld_path)
+        tasks.add('study_cbgs', filter_cbgs, after=['sld', 'counties'])  # filter_cbgs(sld, counties)
+        tasks['study_cbgs']  # waits for the task and returns its result (or raises its error)
+
+    A task gets the results of its `after` tasks as its first arguments. If one of them fails, the task fails with
+    the same error without running. The scheduler is a read-only mapping of task name -> result; `in` and get()
+    only look at the task names, so a task that raises a KeyError raises it instead of looking missing.
+    """
+
+    def __init__(self, max_workers=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task_scheduler')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, func, *args, after=(), **kwargs):
+        if name in self._futures:
+            raise ValueError(f'task {name!r} is already scheduled')
+        missing = [d for d in after if d not in self._futures]
+        if missing:
+            raise KeyError(f'task {name!r} depends on unknown tasks {missing}')
+        deps = [self._futures[d] for d in after]
+        future = self._futures[name] = Future()
+
+        def run():
+            if future.done() or any(d.cancelled() for d in deps):
+                future.cancel()  # the scheduler was cancelled
+                return
+            failed = next((d.exception() for d in deps if d.exception() is not None), None)
+            if failed is not None:
+                future.set_exception(failed)
+                return
+            try:
+                inner = self._executor.submit(func, *[d.result() for d in deps], *args, **kwargs)
+            except RuntimeError:  # the threads were stopped by cancel()
+                future.cancel()
+                return
+            inner.add_done_callback(lambda f: _copy_outcome(f, future))
+
+        pending = [len(deps)]
+
+        def dependency_done(_):
+            with self._lock:
+                pending[0] -= 1
+                ready = pending[0] == 0
+            if ready:
+                run()
+
+        if not deps:
+            run()
+        for d in deps:
+            d.add_done_callback(dependency_done)
+        return future
+
+    def set(self, name, value):
+        """a task whose result is already known"""
+        future = self._futures[name] = Future()
+        future.set_result(value)
+
+    def __getitem__(self, name):
+        return self._futures[name].result()
+
+    def __contains__(self, name):
+        return name in self._futures
+
+    def get(self, name, default=None):
+        return self[name] if name in self._futures else default
+
+    def __iter__(self):
+        return iter(self._futures)
+
+    def __len__(self):
+        return len(self._futures)
+
+    def close(self):
+        """waits for every task (errors stay with their tasks) and stops the threads"""
+        wait(list(self._futures.values()))
+        self._executor.shutdown(wait=True)
+
+    def cancel(self):
+        """cancels the tasks that have not started and stops the threads without waiting for the running ones"""
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # after an error, the remaining reads are not needed: don't make the error wait for them
+        if exc_type is None:
+            self.close()
         else:
-            return None                       # no polygons inside
+            self.cancel()
+        return False
+
+
+def _mask_geometry(mask, crs=None):
+    """mask (GeoDataFrame, GeoSeries or shapely geometry) dissolved into one valid, prepared geometry in crs"""
+    if isinstance(mask, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        if crs is not None and mask.crs is not None and mask.crs != crs:
+            mask = mask.to_crs(crs)
+        mask = shapely.union_all(shapely.make_valid(np.asarray(mask.geometry.values, dtype=object)))
+    shapely.prepare(mask)
+    return mask
+
+
+def _clip_to_mask(gdf, mask):
+    """
+    clips gdf to mask like gpd.clip(gdf, mask), but only features that cross the mask boundary get a real
+    intersection. The mask is dissolved and prepared once, the spatial index of gdf finds the features that touch
+    it, and features entirely inside the mask (contains_properly on the prepared mask) are passed through untouched.
+    The geometries are equivalent to those of gpd.clip (same shapes, but the vertex order or the parts of a
+    multi-geometry can differ) and the rows keep their index, in the order of gdf rather than the order of gpd.clip.
+    :param mask: GeoDataFrame, GeoSeries or shapely geometry (e.g. the result of _mask_geometry, which can be
+        reused for several calls)
+    """
+    mask = _mask_geometry(mask, gdf.crs)
+    candidates = np.sort(gdf.sindex.query(mask, predicate='intersects'))
+    geoms = np.asarray(gdf.geometry.values, dtype=object)[candidates]
+    crossing = ~shapely.contains_properly(mask, geoms)
+    geoms[crossing] = shapely.intersection(geoms[crossing], mask)
+    clipped = gdf.iloc[candidates].copy()
+    clipped[gdf.geometry.name] = gpd.GeoSeries(geoms, index=clipped.index, crs=gdf.crs)
+    return clipped[~clipped.geometry.is_empty]
+
+
+def _file_fingerprint(path):
+    """
+    short hash of the name, size and modification time of a data source. Covers every file of a folder source
+    (.gdb, NCES folders, ...) and the sidecar files of a shapefile (.dbf, .prj, ...).
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
     else:
-        return None                            # other geometry types
+        files = glob.glob(glob.escape(os.path.splitext(path)[0]) + '.*') or [path]
+    digest = hashlib.sha1()
+    for f in sorted(files):
+        stat = os.stat(f)
+        digest.update(f'{f}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:16]
+
+
+def _hash_rows(gdf, columns=None):
+    """
+    64-bit hash of every row of a GeoDataFrame (attributes + geometry WKB), computed in one vectorized pass.
+    Two rows get the same hash only if their attributes and their exact geometry are the same.
+
+    :param gdf: geo dataframe
+    :param columns: attribute columns to include in the hash (default: every non-geometry column)
+    :return: pd.Series of uint64 aligned with gdf.index
+    """
+    geom_col = gdf.geometry.name
+    if columns is None:
+        columns = [c for c in gdf.columns if c != geom_col]
+    frame = pd.DataFrame(gdf[columns]).copy()
+    frame[geom_col] = shapely.to_wkb(gdf.geometry.values, hex=True)
+    return pd.util.hash_pandas_object(frame, index=False)
+
+
+def _hash_geometries(geoms, grid_size=None):
+    """
+    64-bit hash of each geometry that does not depend on vertex order or starting point (geometries are normalized
+    first). With grid_size, coordinates are snapped to that grid so differences below the tolerance don't count.
+    :return: np.ndarray of uint64
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    if grid_size:
+        geoms = shapely.set_precision(geoms, grid_size)
+    wkb = shapely.to_wkb(shapely.normalize(geoms), hex=True)
+    return pd.util.hash_array(wkb.astype(object))
 
 
-def _polygon_to_multipolygon(gdf):
-# turn everything into MultiPolygon.
-    gdf["geometry"] = gdf["geometry"].apply(lambda geom:
-                                            MultiPolygon([geom]) if isinstance(geom, Polygon) else geom)
+def _to_multipolygons(gdf, make_valid=False):
+    """
+    turns every geometry of the frame into a clean MultiPolygon in one vectorized pass: Polygons are wrapped,
+    polygon parts are extracted from (nested) GeometryCollections, lines/points/empty parts are dropped, and rows
+    without any polygon left are removed.
 
+    :param gdf: geo dataframe
+    :param make_valid: run make_valid on the geometries first (in the same pass)
+    :return: a new geo dataframe, same columns and index, only the rows that still have a polygon
+    """
+    geoms = np.asarray(gdf.geometry.values, dtype=object)
+    if make_valid:
+        geoms = shapely.make_valid(geoms)
+    parts, row = shapely.get_parts(geoms, return_index=True)
+    # collections can contain multi geometries (or other collections), flatten until only single parts are left
+    while len(parts) and (shapely.get_type_id(parts) >= 4).any():
+        parts, sub_row = shapely.get_parts(parts, return_index=True)
+        row = row[sub_row]
+    keep = (shapely.get_type_id(parts) == 3) & ~shapely.is_empty(parts)  # 3 == Polygon
+    rows, part_group = np.unique(row[keep], return_inverse=True)
+    clean = gdf.iloc[rows].copy()
+    clean[gdf.geometry.name] = gpd.GeoSeries(shapely.multipolygons(parts[keep], indices=part_group),
+                                             index=clean.index, crs=gdf.crs)
+    return clean
@@ -0,0 +1,99 @@
+"""
+Land-only CBG geometry. The SLD block groups include their water area, and clipping to the cb=True county
+boundaries only removes the coastline part of it, so lakes, rivers and bays inside a county stay in the CBGs (and
+some CBGs are left with only water after the population center difference).
+
+`erase_water` removes a local area-water layer (e.g. the TIGER/Line AREAWATER files of the state, one shapefile per
+county, all in one folder) from the CBGs:
+    - one bulk STRtree query finds the water polygons that touch each CBG, so every CBG is only compared with its own
+      water and not with the whole state
+    - those water polygons are cut to the bounding box of the CBG before they are merged, so a large water body
+      (Puget Sound, Columbia River) is only handled tile by tile, one CBG box at a time
+    - the land left after the difference is split into parts and parts smaller than min_land_area_m2 (slivers
+      between water polygons, small islands) are dropped. CBGs with no land left are removed. CBGs that don't
+      touch any water are not changed.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .ingest import read_projected
+from .spatial_store import is_partitioned_store, read_layer
+
+
+min_land_area_m2 = 10000  # one hectare
+
+
+def read_area_water(water_path, mask=None, crs=None, cache_dir=None):
+    """
+    :param water_path: a water layer (file or partitioned store), or a folder with one layer per county (e.g.
+        tl_2023_53033_areawater.shp / .zip). For a folder, every layer is read and they are concatenated.
+    :param mask: study area. Only the water around it is read
+    :param crs: working CRS. If given, the layers are read with ingest.read_projected (projected once, and cached
+        in cache_dir)
+    :return: geo dataframe of water polygons
+    """
+    print(f'\n---- Reading area water from {water_path}')
+
+    def read(path):
+        if crs is None:
+            return read_layer(path, mask=mask)
+        return read_projected(path, crs, mask=mask, cache_dir=cache_dir)
+
+    if os.path.isdir(water_path) and not is_partitioned_store(water_path) and not water_path.endswith('.gdb'):
+        files = sorted(glob.glob(os.path.join(water_path, '*.shp')) + glob.glob(os.path.join(water_path, '*.zip')))
+        water = pd.concat([read(f) for f in files], ignore_index=True)
+    else:
+        water = read(water_path)
+    water = water[water.geometry.notna() & ~water.geometry.is_empty]
+    print(f'---- \t {len(water)} water polygons')
+    return water
+
+
+def _land_parts(geoms, min_area):
+    """drops polygon parts smaller than min_area. returns MultiPolygons (None where nothing is left)"""
+    parts, source = shapely.get_parts(geoms, return_index=True)
+    keep = (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) & (shapely.area(parts) >= min_area)
+    result = np.full(len(geoms), None, dtype=object)
+    if keep.any():
+        has_land = np.unique(source[keep])
+        result[has_land] = shapely.multipolygons(parts[keep], indices=np.searchsorted(has_land, source[keep]))
+    return result
+
+
+def erase_water(CBG_gdf, water_gdf, min_land_area=min_land_area_m2):
+    """
+    removes the area water from the CBG geometries (see the module docstring). Both layers must be in the same
+    projected CRS.
+    :param min_land_area: smallest land part (in CRS units squared) that is kept
+    :return: the CBGs with land-only MultiPolygon geometry and a 'land_area_m2' column
+    """
+    print(f'\n---- Erasing water from {len(CBG_gdf)} census block groups')
+    if water_gdf.crs != CBG_gdf.crs:
+        raise ValueError(f'CBGs are in {CBG_gdf.crs} but water is in {water_gdf.crs}')
+    cbgs = np.asarray(CBG_gdf.geometry.values, dtype=object)
+    water = shapely.make_valid(np.asarray(water_gdf.geometry.values, dtype=object))
+
+    cbg_i, water_j = shapely.STRtree(water).query(cbgs, predicate='intersects')
+    # water of every pair cut to the box of its CBG, then merged per CBG
+    order = np.argsort(cbg_i, kind='stable')
+    cbg_i, water_j = cbg_i[order], water_j[order]
+    tiles = shapely.intersection(water[water_j], shapely.box(*shapely.bounds(cbgs[cbg_i]).T))
+    with_water, starts = np.unique(cbg_i, return_index=True)
+
+    # CBGs without any water are kept as they are
+    land = cbgs.copy()
+    if len(with_water):
+        water_union = np.array([shapely.union_all(group) for group in np.split(tiles, starts[1:])], dtype=object)
+        land[with_water] = _land_parts(shapely.difference(cbgs[with_water], water_union), min_land_area)
+
+    result = CBG_gdf.copy()
+    result['geometry'] = land
+    result = result[result.geometry.notna()].copy()
+    result['land_area_m2'] = result.geometry.area
+    print(f'---- \t {len(with_water)} census block groups touched water, '
+          f'{len(CBG_gdf) - len(result)} had no land left and were removed')
+    return result
@@ -15,6 +15,10 @@ if __name__ == '__main__':
     # nces_path = parameters[11]
     # output_gdb = parameters[12]
     # save_path = parameters[13]
+    # road_buffer_sweep = parameters[14]
+    # bike_paths_fc = parameters[15]
+    # water_path = parameters[16]
+    # distance_bands_mi = parameters[17]
 
     state_in = 'WA'
     counties_in = ["King", "Pierce", "Snohomish", "Kitsap", "Skagit",
@@ -30,6 +34,9 @@ if __name__ == '__main__':
     bike_roads_along_SR = r"C:\Users\Soheil99\OneDrive - UW\0 Research\UW Tacoma\my copy - Satellite Communities Project\Data\WSDOT_-_Bike_Paths_Along_State_Routes\WSDOT_-_Bike_Paths_Along_State_Routes.shp"
     parcel_fc = r"C:\Users\Soheil99\OneDrive - UW\0 Research\UW Tacoma\my copy - Satellite Communities Project\Data\Current_Parcels\Parcels_2024.shp"
     road_buffer_dist = 300
+    road_buffer_sweep = [150, 300, 500, 1000, 2640]
+    distance_bands_mi = [1, 3, 5]
+    area_water_path = r"C:/Users/Soheil99/OneDrive - UW/0 Research/UW Tacoma/my copy - Satellite Communities Project/Data/TIGER_AREAWATER_WA"
     nces_WA_path = r"C:/Users/Soheil99/OneDrive - UW/0 Research/UW Tacoma/my copy - Satellite Communities Project/Data/edge_locale24_nces_WA"
     output_gdb = r"C:\Users\Soheil99\OneDrive - UW\0 Research\UW Tacoma\my copy - Satellite Communities Project\Analysis\RuralATGapFinder\out\out.gdb"
     save_path = r"C:\Users\Soheil99\OneDrive - UW\0 Research\UW Tacoma\my copy - Satellite Communities Project\Analysis\RuralATGapFinder\out"
@@ -37,7 +44,8 @@ if __name__ == '__main__':
     test = RuralActiveTransportAnalysis()
     parameters = [state_in, 'COUNTY', counties_in, pop_ctr_path, sld_gdb_path,
                   state_roads_fc, county_roads_fc, parcel_fc, 'LANDUSE_CD', POI_path,
-                  road_buffer_dist, nces_WA_path, output_gdb, save_path]
+                  road_buffer_dist, nces_WA_path, output_gdb, save_path, road_buffer_sweep,
+                  bike_roads_along_SR, area_water_path, distance_bands_mi]
     # parameters = r'C:\Users\Soheil99\OneDrive - UW\0 Research\UW Tacoma\my copy - Satellite Communities Project\Analysis\RuralATGapFinder\assets\example.yml'
     test.execute(parameters, None)
 
@@ -0,0 +1,54 @@
+"""
+Output diff on layers with and without a key column.
+
+    python -m pytest tests
+"""
+import geopandas as gpd
+import shapely
+
+from src.diff_outputs import diff_layers, diff_output_dirs
+
+
+def _parcels():
+    # ids repeat across counties, so PARCEL_ID_ is not a key
+    return gpd.GeoDataFrame({'FIPS_NR': [53033, 53033, 53053, 53053], 'PARCEL_ID_': [1, 2, 1, 2],
+                             'ALLOC_POP': [1.5, 2.0, 3.25, 0.0], 'PC_BAND': ['0-1', '1-3', '3-5', '>5']},
+                            geometry=[shapely.box(i, 0, i + 1, 1) for i in range(4)], crs=32610)
+
+
+def _changes(d):
+    return len(d['added']) + len(d['removed']) + len(d['geometry_changed']) + len(d['attributes'])
+
+
+def test_unkeyed_attribute_change():
+    old, new = _parcels(), _parcels()
+    new.loc[1, 'ALLOC_POP'] *= 5
+    new.loc[2, 'PC_BAND'] = '1-3'
+    d = diff_layers(old, new)
+    assert d['key'] is None
+    assert len(d['added']) == len(d['removed']) == 2
+
+
+def test_unkeyed_same_rows_in_other_order():
+    old = _parcels()
+    new = old.iloc[::-1].astype({'ALLOC_POP': 'float32'})
+    new.geometry = new.geometry.normalize()
+    assert _changes(diff_layers(old, new)) == 0
+
+
+def test_keyed_attribute_change():
+    old, new = _parcels().iloc[:2], _parcels().iloc[:2]
+    new.loc[1, 'ALLOC_POP'] = 7.0
+    d = diff_layers(old, new)
+    assert d['key'] == 'PARCEL_ID_'
+    assert d['attributes'].to_dict() == {'ALLOC_POP': 1}
+
+
+def test_diff_output_dirs(tmp_path):
+    old, new = _parcels(), _parcels()
+    new.loc[0, 'ALLOC_POP'] = 10.0
+    for name, gdf in (('old', old), ('new', new)):
+        (tmp_path / name).mkdir()
+        gdf.to_file(tmp_path / name / 'parcels_out_pc.gpkg')
+    summary = diff_output_dirs(str(tmp_path / 'old'), str(tmp_path / 'new'))
+    assert summary['status'].tolist() == ['changed']
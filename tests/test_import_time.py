@@ -0,0 +1,59 @@
+"""
+Importing the pipeline modules must stay under a time budget and must not pull in arcpy or the optional packages
+(pygris, matplotlib), which are only imported by the functions that need them. `python -m src.cli --help` must not
+even import the geo stack.
+
+    python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds per module in a fresh interpreter. The pipeline modules import geopandas (about 0.5 s on a warm cache),
+# the budget leaves room for a cold one
+import_budgets_s = {'src.cli': 1.0, 'src.preprocess': 3.0, 'src.process_poi': 3.0}
+lazy_modules = ('arcpy', 'pygris', 'matplotlib')
+geo_modules = ('geopandas', 'shapely')
+
+_probe = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(','.join(sys.modules))
+"""
+
+
+def _import(module):
+    """import time (s) of module in a fresh interpreter, and the modules loaded after it"""
+    out = subprocess.run([sys.executable, '-c', _probe.format(module=module)], cwd=repo_dir, capture_output=True,
+                         text=True, check=True)
+    seconds, modules = out.stdout.splitlines()[-2:]
+    return float(seconds), set(modules.split(','))
+
+
+@pytest.fixture(scope='module', params=sorted(import_budgets_s))
+def imported(request):
+    return (request.param,) + _import(request.param)
+
+
+def test_import_budget(imported):
+    module, seconds, _ = imported
+    assert seconds < import_budgets_s[module], \
+        f'importing {module} took {seconds:.2f} s (budget {import_budgets_s[module]} s)'
+
+
+def test_imports_lazily(imported):
+    module, _, modules = imported
+    eager = [m for m in lazy_modules if m in modules]
+    assert not eager, f'importing {module} imported {eager}'
+
+
+def test_cli_does_not_import_the_geo_stack():
+    _, modules = _import('src.cli')
+    eager = [m for m in geo_modules if m in modules]
+    assert not eager, f'importing src.cli imported {eager}'
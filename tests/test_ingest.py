@@ -0,0 +1,42 @@
+"""
+Projected copies of the inputs in the cache folder.
+
+    python -m pytest tests
+"""
+import os
+
+import geopandas as gpd
+import shapely
+
+from src.ingest import projected_dirname, read_projected
+
+
+def _write(path, x):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gpd.GeoDataFrame({'v': [x]}, geometry=[shapely.Point(500000 + x, 5200000)], crs=32610).to_file(path)
+
+
+def _copies(cache_dir):
+    return sorted(os.listdir(os.path.join(cache_dir, projected_dirname)))
+
+
+def test_same_file_name_in_two_folders(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    a, b = str(tmp_path / 'a' / 'Parcels.shp'), str(tmp_path / 'b' / 'Parcels.shp')
+    _write(a, 1)
+    _write(b, 2)
+    for _ in range(2):
+        assert read_projected(a, 32610, cache_dir=cache_dir)['v'].tolist() == [1]
+        assert read_projected(b, 32610, cache_dir=cache_dir)['v'].tolist() == [2]
+    assert len(_copies(cache_dir)) == 2
+
+
+def test_new_version_replaces_the_old_copy(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    path = str(tmp_path / 'Parcels.shp')
+    _write(path, 1)
+    read_projected(path, 32610, cache_dir=cache_dir)
+    first = _copies(cache_dir)
+    _write(path, 3)
+    assert read_projected(path, 32610, cache_dir=cache_dir)['v'].tolist() == [3]
+    assert len(_copies(cache_dir)) == 1 and _copies(cache_dir) != first
@@ -0,0 +1,57 @@
+"""
+Incremental parcel runs on a shapefile, where PARCEL_ID_NR is cut to PARCEL_ID_ and parcel ids repeat across
+counties.
+
+    python -m pytest tests
+"""
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from src.preprocess import CRS, preprocess_parcels
+
+
+# the shapefile cutting the column name is the point of these tests
+pytestmark = pytest.mark.filterwarnings('ignore:.*(truncated|laundered)')
+
+
+def _parcels():
+    # two counties side by side with the same parcel ids
+    cells = [(county, i, shapely.box(county * 1000 + i * 50, 0, county * 1000 + i * 50 + 40, 40))
+             for county in (0, 1) for i in range(10)]
+    return gpd.GeoDataFrame({'FIPS_NR': [53000 + c for c, _, _ in cells], 'PARCEL_ID_NR': [i for _, i, _ in cells],
+                             'LANDUSE_CD': 11}, geometry=[g for _, _, g in cells], crs=CRS)
+
+
+def _run(parcels, tmp_path, capsys):
+    path = tmp_path / 'Parcels.shp'
+    parcels.to_file(path)
+    studyarea = gpd.GeoDataFrame(geometry=[shapely.box(-100, -100, 2000, 100)], crs=CRS)
+    pop_centers = gpd.GeoDataFrame(geometry=[shapely.box(-100, -100, 95, 100)], crs=CRS)
+    result = preprocess_parcels(str(path), studyarea, pop_centers, str(tmp_path / 'out'), incremental=True)
+    return result, capsys.readouterr().out
+
+
+def test_shapefile_round_trip_keeps_the_parcel_id(tmp_path):
+    path = tmp_path / 'Parcels.shp'
+    _parcels().to_file(path)
+    assert 'PARCEL_ID_' in gpd.read_file(path).columns
+
+
+def test_incremental_run_on_shapefile(tmp_path, capsys):
+    (tmp_path / 'out').mkdir()
+    parcels = _parcels()
+    first, out = _run(parcels, tmp_path, capsys)
+    assert 'incremental mode is disabled' not in out
+    # the two parcels in the population center are dropped
+    assert len(first) == 18
+
+    # parcel 5 of the second county changes, the same id in the first county does not
+    parcels.loc[(parcels['FIPS_NR'] == 53001) & (parcels['PARCEL_ID_NR'] == 5), 'LANDUSE_CD'] = 12
+    second, out = _run(parcels, tmp_path, capsys)
+    assert 'incremental run: 1 added/changed and 0 removed parcels out of 20' in out
+    assert len(second) == 18
+    changed = second[(second['FIPS_NR'] == 53001) & (second['PARCEL_ID_'] == 5)]
+    assert changed['LANDUSE_CD'].tolist() == [12]
+    assert np.sort(second['PARCEL_ID_'].values).tolist() == np.sort(first['PARCEL_ID_'].values).tolist()
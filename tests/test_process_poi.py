@@ -0,0 +1,63 @@
+"""
+POI deduplication and the road distance sweep on small synthetic layers.
+
+    python -m pytest tests
+"""
+import json
+
+import geopandas as gpd
+import shapely
+
+from src.process_poi import _normalize_name, deduplicate_POIs, poi_road_distance_sweep
+
+
+_grocery = json.dumps({'primary': 'grocery_store', 'alternate': []})
+
+
+def _pois(points, names=None):
+    names = names or [f'poi {i}' for i in range(len(points))]
+    return gpd.GeoDataFrame({'names': [{'primary': n} for n in names], 'categories': [_grocery] * len(points),
+                             'confidence': 0.9}, geometry=[shapely.Point(p) for p in points], crs=32610)
+
+
+def _roads():
+    return gpd.GeoDataFrame({'GEOID10': ['530330001001']}, geometry=[shapely.LineString([(-500, 0), (500, 0)])],
+                            crs=32610)
+
+
+def test_sweep_counts_per_band():
+    result = poi_road_distance_sweep(_pois([(0, 30), (100, 120), (0, 5000)]), _roads(), [150, 500])
+    assert result['summary']['all_POIs'].tolist() == [1, 2]
+    assert result['categories'].loc['grocery_store'].tolist() == [1, 2]
+
+
+def test_sweep_without_POIs():
+    result = poi_road_distance_sweep(_pois([]).iloc[:0], _roads(), [150, 500])
+    assert list(result['summary'].columns) == ['relevant_POIs', 'other_POIs', 'all_POIs']
+    assert result['summary'].index.tolist() == [150, 500]
+    assert (result['summary'].dtypes == int).all()
+    assert result['CBGs'].values.tolist() == [[0, 0]]
+
+
+def test_sweep_with_no_POI_reached():
+    result = poi_road_distance_sweep(_pois([(0, 5000)]), _roads(), [150, 500])
+    assert result['summary'].values.tolist() == [[0, 0, 0], [0, 0, 0]]
+    assert (result['categories'].dtypes == int).all()
+
+
+def test_sweep_with_repeated_distances():
+    result = poi_road_distance_sweep(_pois([(0, 30)]), _roads(), [300, 300, 150])
+    assert result['summary'].index.tolist() == [150, 300]
+
+
+def test_normalize_name_drops_apostrophes():
+    assert _normalize_name("Joe's Cafe") == _normalize_name('Joes Cafe') == _normalize_name('JOE’S CAFE')
+    assert _normalize_name('Joe Cafe') != _normalize_name('Joes Cafe')
+
+
+def test_deduplicate_merges_apostrophe_variants():
+    pois = _pois([(0, 0), (5, 0), (500, 0)], names=["Joe's Cafe", 'Joes Cafe', 'Joes Cafe'])
+    pois['primary_category'] = 'grocery_store'
+    deduplicated, merged = deduplicate_POIs(pois)
+    assert len(deduplicated) == 2
+    assert merged.to_dict() == {'grocery_store': 1}
@@ -0,0 +1,51 @@
+"""
+TaskScheduler: errors of tasks and leaving the scheduler after an error.
+
+    python -m pytest tests
+"""
+import threading
+import time
+
+import pytest
+
+from src.utils import TaskScheduler
+
+
+def _missing_key():
+    return {}['column']
+
+
+def test_task_key_error_is_not_a_missing_task():
+    with TaskScheduler() as tasks:
+        tasks.add('layer', _missing_key)
+        assert 'layer' in tasks
+        assert 'other' not in tasks
+        assert tasks.get('other') is None
+        with pytest.raises(KeyError, match='column'):
+            tasks.get('layer')
+
+
+def test_dependent_tasks():
+    with TaskScheduler() as tasks:
+        tasks.add('a', lambda: 1)
+        tasks.add('b', lambda a: a + 1, after=['a'])
+        tasks.add('c', lambda b: _missing_key(), after=['b'])
+        tasks.add('d', lambda c: c, after=['c'])
+        assert tasks['b'] == 2
+        with pytest.raises(KeyError):
+            tasks['d']
+
+
+def test_error_does_not_wait_for_pending_tasks():
+    release, ran = threading.Event(), []
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        with TaskScheduler(max_workers=1) as tasks:
+            tasks.add('slow', release.wait, 5)
+            tasks.add('queued', lambda: ran.append('queued'))
+            tasks.add('after_slow', lambda slow: ran.append('after_slow'), after=['slow'])
+            raise ValueError('the pipeline failed')
+    assert time.perf_counter() - start < 1
+    release.set()
+    time.sleep(0.2)
+    assert ran == []